@@ -1,9 +1,16 @@
 from keras.callbacks import Callback
 import pandas as pd
 import numpy as np
+import copy
+import os
+import pickle
+import random
+import threading
 from time import time
 import warnings
 
+import deepcpg.io as io
+
 
 class EarlyStopping(Callback):
     def __init__(self, monitor='val_loss', patience=0, verbose=0):
@@ -35,6 +42,13 @@ class EarlyStopping(Callback):
                     print("Epoch %d: early stopping" % (epoch))
                 self.model.stop_training = True
 
+    def get_state(self):
+        return {'best_score': self.best_score, 'counter': self.counter}
+
+    def set_state(self, state):
+        self.best_score = state['best_score']
+        self.counter = state['counter']
+
 
 class LearningRateScheduler(Callback):
 
@@ -61,6 +75,15 @@ class LearningRateScheduler(Callback):
                 self.model.set_weights(self.best_weights)
                 self.counter = 0
 
+    def get_state(self):
+        return {'best_score': self.best_score, 'counter': self.counter,
+                'best_weights': self.best_weights}
+
+    def set_state(self, state):
+        self.best_score = state['best_score']
+        self.counter = state['counter']
+        self.best_weights = state['best_weights']
+
 
 class PerformanceLogger(Callback):
 
@@ -73,11 +96,17 @@ class PerformanceLogger(Callback):
         self.batch_logs = batch_logs
         self.epoch_logs = epoch_logs
         self.callbacks = callbacks
-
-    def on_train_begin(self, logs={}):
         self._batch_logs = []
         self._epoch_logs = []
 
+    def get_state(self):
+        return {'batch_logs': self._batch_logs,
+                'epoch_logs': self._epoch_logs}
+
+    def set_state(self, state):
+        self._batch_logs = state['batch_logs']
+        self._epoch_logs = state['epoch_logs']
+
     def on_epoch_begin(self, epoch, logs={}):
         self._batch_logs.append([])
 
@@ -91,12 +120,24 @@ class PerformanceLogger(Callback):
         for cb in self.callbacks:
             cb()
 
+    def update_epoch(self, logs):
+        """Adds `logs` of callbacks after this one to the last epoch."""
+        if len(self._epoch_logs):
+            self._epoch_logs[-1].update(
+                {k: v for k, v in logs.items() if k in self.epoch_logs})
+
+    def on_train_end(self, logs={}):
+        for cb in self.callbacks:
+            cb()
+
     def _list_to_frame(self, l, keys):
-        keys = [k for k in keys if k in l[0].keys()]
+        # Empty if training stopped before the first epoch ended
+        if len(l):
+            keys = [k for k in keys if any([k in ll for ll in l])]
         d = {k: [] for k in keys}
         for ll in l:
             for k in keys:
-                d[k].append(float(ll[k]))
+                d[k].append(float(ll.get(k, np.nan)))
         d = pd.DataFrame(d, columns=keys)
         return d
 
@@ -116,7 +157,11 @@ class PerformanceLogger(Callback):
                 de['epoch'] = e + 1
                 de = de.loc[:, ['epoch'] + t]
                 d.append(de)
-            d = pd.concat(d)
+            if len(d):
+                d = pd.concat(d)
+            else:
+                d = pd.DataFrame(columns=['epoch', 'batch'] +
+                                 self.batch_logs)
         else:
             d = self._list_to_frame(self._batch_logs[epoch - 1],
                                     self.batch_logs)
@@ -176,6 +221,7 @@ class ProgressLogger(Callback):
         self._log(self._line)
         self._seen = 0
         self._totals = dict()
+        self._time_epoch = time()
 
     def on_batch_end(self, batch, logs={}):
         self._batch += 1
@@ -198,6 +244,8 @@ class ProgressLogger(Callback):
                 self._nb_batch,
                 mins
             )
+            s += '\t%.1f samples/s' % (
+                self._seen / max(time() - self._time_epoch, 1e-5))
             for k, v in self._totals.items():
                 s += '\t%s=%.3f' % (k, v / max(self._seen, 1e-5))
             self._log(s)
@@ -244,6 +292,181 @@ class DataJumper(Callback):
             d = self.data[0]
             print('Index: (%d - %d)' % (d.start, d.stop))
 
+    def get_state(self):
+        return [(d.start, d.stop) for d in self.data]
+
+    def set_state(self, state):
+        for d, (start, stop) in zip(self.data, state):
+            d.start = start
+            d.stop = stop
+
+
+class StopTraining(Exception):
+    pass
+
+
+class Validator(Callback):
+    """Evaluates in-memory validation data every `every` batches.
+
+    The validation loss is passed as `val_loss` to `on_epoch_end` of
+    `callbacks`, e.g. EarlyStopping, LearningRateScheduler, or
+    AsyncCheckpoint, which thereby act per validation. If they stop
+    training, StopTraining is raised to end the epoch early. The loss of the
+    last validation is added to epoch logs.
+    """
+
+    def __init__(self, data, sample_weight, every=1000, batch_size=128,
+                 callbacks=[], verbose=0):
+        super(Validator, self).__init__()
+        self.data = data
+        self.sample_weight = sample_weight
+        self.every = every
+        self.batch_size = batch_size
+        self.callbacks = callbacks
+        self.verbose = verbose
+        self._step = 0
+        self._logs = []
+
+    def _set_model(self, model):
+        self.model = model
+        for cb in self.callbacks:
+            cb._set_model(model)
+
+    def _set_params(self, params):
+        self.params = params
+        for cb in self.callbacks:
+            cb._set_params(params)
+
+    def get_state(self):
+        states = []
+        for cb in self.callbacks:
+            if hasattr(cb, 'get_state'):
+                states.append(cb.get_state())
+            else:
+                states.append(None)
+        return {'step': self._step, 'logs': self._logs, 'callbacks': states}
+
+    def set_state(self, state):
+        self._step = state['step']
+        self._logs = state['logs']
+        for cb, s in zip(self.callbacks, state['callbacks']):
+            if s is not None:
+                cb.set_state(s)
+
+    def frame(self):
+        return pd.DataFrame(self._logs, columns=['epoch', 'batch',
+                                                 'val_loss'])
+
+    def validate(self):
+        loss = self.model.evaluate(self.data, batch_size=self.batch_size,
+                                   sample_weight=self.sample_weight,
+                                   verbose=0)
+        if isinstance(loss, list):
+            loss = loss[0]
+        logs = {'val_loss': float(loss)}
+        self._logs.append({'epoch': self._epoch + 1, 'batch': self._batch,
+                           'val_loss': logs['val_loss']})
+        if self.verbose:
+            print('Batch %d: val_loss=%.4f' % (self._batch,
+                                               logs['val_loss']))
+        for cb in self.callbacks:
+            cb.on_epoch_end(self._step, logs)
+        self._step += 1
+
+    def on_train_begin(self, logs={}):
+        for cb in self.callbacks:
+            cb.on_train_begin(logs)
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self._epoch = epoch
+        self._batch = 0
+
+    def on_batch_end(self, batch, logs={}):
+        self._batch += 1
+        if self._batch % self.every == 0:
+            self.validate()
+            if self.model.stop_training:
+                raise StopTraining()
+
+    def on_epoch_end(self, epoch, logs={}):
+        if self._batch % self.every or not len(self._logs):
+            self.validate()
+        logs['val_loss'] = self._logs[-1]['val_loss']
+
+    def on_train_end(self, logs={}):
+        for cb in self.callbacks:
+            cb.on_train_end(logs)
+
+
+class StepTimer(object):
+    """Measures wall time of training steps.
+
+    `head` and `tail` must be the first and last callbacks. Batch logs get
+    the time for reading data through io.TimedView `views` (t_fetch), the
+    remaining time of the step (t_compute), and the time spent in callbacks
+    since the previous step (t_callbacks).
+    """
+
+    def __init__(self, views=[]):
+        self.views = views
+        self.head = StepTimerHead(self)
+        self.tail = StepTimerTail(self)
+
+    def fetched(self):
+        return sum([v.elapsed for v in self.views])
+
+
+class StepTimerHead(Callback):
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def on_batch_begin(self, batch, logs={}):
+        self.timer._t_begin = time()
+
+    def on_batch_end(self, batch, logs={}):
+        timer = self.timer
+        t = time()
+        fetch = timer.fetched() - timer._fetched
+        logs['t_fetch'] = fetch
+        logs['t_compute'] = t - timer._t_end - timer._t_callbacks - fetch
+        logs['t_callbacks'] = timer._t_callbacks + timer._t_callbacks_end
+        timer._t_begin = t
+
+
+class StepTimerTail(Callback):
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.timer._t_end = time()
+        self.timer._fetched = self.timer.fetched()
+        self.timer._t_callbacks_end = 0
+
+    def on_batch_begin(self, batch, logs={}):
+        self.timer._t_callbacks = time() - self.timer._t_begin
+
+    def on_batch_end(self, batch, logs={}):
+        timer = self.timer
+        timer._t_end = time()
+        timer._t_callbacks_end = timer._t_end - timer._t_begin
+        timer._fetched = timer.fetched()
+
+
+class ChunkShuffler(Callback):
+    """Draws new chunk order of io.ChunkSampler each epoch."""
+
+    def __init__(self, sampler, verbose=0):
+        self.sampler = sampler
+        self.verbose = verbose
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.sampler.shuffle()
+        if self.verbose:
+            print('Chunks: %d of %d rows' % (len(self.sampler._chunks),
+                                             self.sampler.chunk_size))
+
 
 class Timer(Callback):
 
@@ -263,3 +486,129 @@ class Timer(Callback):
             if self.verbose:
                 print('Stop training after %.2fh' % (elapsed / 3600))
             self.model.stop_training = True
+
+
+class AsyncCheckpoint(Callback):
+    """Writes weights and training state in a background thread.
+
+    At the end of each epoch, weights are copied and written to `last_file`
+    and, if `monitor` improved, to `best_file` in the format of
+    Graph.save_weights. `state_file` is a pickle of the optimizer state,
+    learning rate, epoch, RNG states, and states of `callbacks` with a
+    `get_state` method, from which training can be resumed. Files are
+    replaced atomically, such that an interrupted write leaves the previous
+    checkpoint intact. The time training was blocked is added to the last
+    epoch of PerformanceLogger `perf_logger` as `t_checkpoint`.
+    """
+
+    def __init__(self, last_file, best_file=None, state_file=None,
+                 callbacks=[], monitor='val_loss', perf_logger=None,
+                 verbose=0):
+        super(AsyncCheckpoint, self).__init__()
+        self.perf_logger = perf_logger
+        self.last_file = last_file
+        self.best_file = best_file
+        self.state_file = state_file
+        self.callbacks = callbacks
+        self.monitor = monitor
+        self.verbose = verbose
+        self.epoch = 0
+        self.best_score = np.inf
+        self.state = dict()
+        self._thread = None
+        self._error = None
+
+    def get_state(self):
+        return {'epoch': self.epoch, 'best_score': self.best_score}
+
+    def set_state(self, state):
+        self.epoch = state['epoch']
+        self.best_score = state['best_score']
+
+    def snapshot(self):
+        state = dict(self.state)
+        state['epoch'] = self.epoch
+        state['stop_training'] = self.model.stop_training
+        state['optimizer'] = self.model.optimizer.get_state()
+        state['lr'] = self.model.optimizer.lr.get_value()
+        state['np_random'] = np.random.get_state()
+        state['random'] = random.getstate()
+        state['checkpoint'] = self.get_state()
+        state['callbacks'] = []
+        for cb in self.callbacks:
+            if hasattr(cb, 'get_state'):
+                # Copy, since callbacks change states while writing
+                state['callbacks'].append(copy.deepcopy(cb.get_state()))
+            else:
+                state['callbacks'].append(None)
+        return state
+
+    def restore(self, state):
+        """Restores training state except weights from snapshot."""
+        self.model.optimizer.set_state(state['optimizer'])
+        self.model.optimizer.lr.set_value(state['lr'])
+        np.random.set_state(state['np_random'])
+        random.setstate(state['random'])
+        self.set_state(state['checkpoint'])
+        for cb, s in zip(self.callbacks, state['callbacks']):
+            if s is not None:
+                cb.set_state(s)
+
+    def _replace(self, path, write):
+        tmp = '%s.tmp' % (path)
+        write(tmp)
+        os.replace(tmp, path)
+
+    def _dump(self, state, path):
+        with open(path, 'wb') as f:
+            pickle.dump(state, f)
+
+    def _write(self, weights, files, state):
+        try:
+            for path in files:
+                self._replace(path, lambda x: io.write_weights(x, weights))
+            if state is not None:
+                self._replace(self.state_file,
+                              lambda x: self._dump(state, x))
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        """Waits for pending write and raises its error."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            e = self._error
+            self._error = None
+            raise e
+
+    def on_epoch_end(self, epoch, logs={}):
+        t = time()
+        self.wait()
+        self.epoch += 1
+        files = []
+        if self.last_file is not None:
+            files.append(self.last_file)
+        score = logs.get(self.monitor)
+        if self.best_file is not None and score is not None and \
+                score < self.best_score:
+            if self.verbose:
+                print('Epoch %d: %s improved from %.4f to %.4f' %
+                      (self.epoch, self.monitor, self.best_score, score))
+            self.best_score = score
+            files.append(self.best_file)
+        state = None
+        if self.state_file is not None:
+            state = self.snapshot()
+        self._thread = threading.Thread(
+            target=self._write,
+            args=(self.model.get_weights(), files, state))
+        self._thread.start()
+        # Time training was blocked
+        logs['t_checkpoint'] = time() - t
+        if self.perf_logger is not None:
+            self.perf_logger.update_epoch(logs)
+
+    def on_train_end(self, logs={}):
+        self.wait()
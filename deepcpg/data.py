@@ -0,0 +1,271 @@
+import os.path as pt
+import h5py as h5
+import numpy as np
+import gc
+
+import deepcpg.io as io
+
+
+MAX_DIST = 10**6
+
+
+def read_anno(annos_file, chromo, name, pos=None):
+    f = h5.File(annos_file, 'r')
+    d = {k: f[pt.join(chromo, name, k)].value for k in ['pos', 'annos']}
+    f.close()
+    if pos is not None:
+        t = np.in1d(d['pos'], pos)
+        for k in d.keys():
+            d[k] = d[k][t]
+        assert np.all(d['pos'] == pos)
+    d['annos'][d['annos'] >= 0] = 1
+    d['annos'][d['annos'] < 0] = 0
+    d['annos'] = d['annos'].astype('bool')
+    return d['pos'], d['annos']
+
+
+def read_annos(annos_file, chromo, names, *args, **kwargs):
+    pos = None
+    annos = []
+    for name in names:
+        p, a = read_anno(annos_file, chromo, name, *args, **kwargs)
+        if pos is None:
+            pos = p
+        else:
+            assert np.all(pos == p)
+        annos.append(a)
+    annos = np.vstack(annos).T
+    return pos, annos
+
+
+def anno_bits(annos_file, chromo, names, pos):
+    """Returns boolean matrix whether sites `pos` are in annotations `names`.
+
+    Unlike `read_annos`, sites do not need to be annotated by all
+    annotations.
+    """
+    f = h5.File(annos_file, 'r')
+    bits = np.zeros((len(pos), len(names)), dtype='bool')
+    for j, name in enumerate(names):
+        g = pt.join(chromo, name)
+        if g not in f:
+            continue
+        p = f[g]['pos'].value
+        a = f[g]['annos'].value >= 0
+        if len(p) == 0:
+            continue
+        t = np.argsort(p)
+        p = p[t]
+        a = a[t]
+        i = np.minimum(np.searchsorted(p, pos), len(p) - 1)
+        bits[:, j] = (p[i] == pos) & a[i]
+    f.close()
+    return bits
+
+
+def read_pos(path, chromo, nb_sample=None):
+    f = h5.File(path, 'r')
+    p = f['/cpg/%s/pos' % (chromo)]
+    if nb_sample:
+        p = p[:nb_sample]
+    else:
+        p = p.value
+    return p
+
+
+def read_pos_all(data_files, *args, **kwargs):
+    pos = [read_pos(x, *args, **kwargs) for x in data_files]
+    t = set()
+    for p in pos:
+        t.update(p)
+    pos = np.array(sorted(t))
+    return pos
+
+
+def adjust_pos(y, p, q):
+    yq = np.empty(len(q), dtype='int8')
+    yq.fill(io.MASK)
+    t = np.in1d(q, p).nonzero()[0]
+    yq.flat[t] = y
+    return yq
+
+
+def read_cpg(path, chromo, pos=None):
+    f = h5.File(path, 'r')
+    p = f['/cpg/%s/pos' % (chromo)].value
+    c = f['/cpg/%s/cpg' % (chromo)].value
+    f.close()
+    if pos is not None:
+        c = adjust_pos(c, p, pos)
+        p = pos
+    c = c.astype('int8')
+    return c
+
+
+def read_knn(path, chromo, pos=None, what='knn', knn_group='knn_shared',
+             knn=None, rows=None):
+    """Reads KNN features of `pos`, which are within `rows` (start, stop)
+    of the file if given."""
+    f = h5.File(path, 'r')
+    g = f['/%s/%s' % (knn_group, chromo)]
+    lo, hi = rows or (0, g['pos'].shape[0])
+    p = g['pos'][lo:hi]
+    d = g[what]
+    if knn is None:
+        d = d[lo:hi]
+    else:
+        assert knn % 2 == 0
+        assert knn <= d.shape[1]
+        c = d.shape[1] // 2
+        t = knn // 2
+        d = d[lo:hi, c-t:c+t]
+    f.close()
+    if pos is not None:
+        t = np.in1d(p, pos)
+        d = d[t]
+    return d
+
+
+def read_knn_dist(max_dist=MAX_DIST, *args, **kwargs):
+    d = read_knn(what='dist', *args, **kwargs)
+    d = np.array(np.minimum(max_dist, d) / max_dist, dtype='float16')
+    return d
+
+
+def read_knn_all(paths, *args, **kwargs):
+    rows = kwargs.pop('rows', None) or dict()
+    d = [read_knn(x, rows=rows.get(x), *args, **kwargs) for x in paths]
+
+    T = len(d)  # targets
+    N = d[0].shape[0]  # samples
+    M = d[0].shape[1]  # win_len
+    C = 2  # features
+    d = np.hstack(d).reshape(N, T, M).reshape(-1)
+
+    t = [read_knn_dist(path=x, rows=rows.get(x), *args, **kwargs)
+         for x in paths]
+    t = np.hstack(t).reshape(N, T, M).reshape(-1)
+
+    d = np.vstack((d, t)).T
+    del t
+    gc.collect()
+
+    d = d.reshape(N, T, M, C)  # combined
+    d = d.swapaxes(2, 3).swapaxes(1, 2)
+    assert d.shape == (N, C, T, M)
+    return d
+
+
+def encode_seqs(seqs, dim=4):
+    """Special nucleotides will be encoded as [0, 0, 0, 0]."""
+    n = seqs.shape[0]
+    l = seqs.shape[1]
+    #  t = seqs >= dim
+    #  seqs[t] = np.random.randint(0, dim, t.sum())
+    enc_seqs = np.zeros((n, l, dim), dtype='int8')
+    for i in range(dim):
+        t = seqs == i
+        enc_seqs[t, i] = 1
+    return enc_seqs
+
+
+def read_seq(path, chromo, pos=None, seq_len=None, rows=None):
+    f = h5.File(path, 'r')
+    lo, hi = rows or (0, f['/%s/pos' % (chromo)].shape[0])
+    p = f['/%s/pos' % (chromo)][lo:hi]
+    s = f['/%s/seq' % (chromo)]
+    if seq_len is None:
+        s = s[lo:hi]
+    else:
+        assert seq_len % 2 == 1
+        assert seq_len <= s.shape[1]
+        c = s.shape[1] // 2
+        d = seq_len // 2
+        s = s[lo:hi, c-d:c+d+1]
+        assert s.shape[1] == seq_len
+    f.close()
+    if pos is not None:
+        t = np.in1d(p, pos)
+        p = p[t]
+        assert np.all(p == pos)
+        s = s[t]
+        assert s.shape[0] == len(pos)
+    return s
+
+
+def read_stat(stats_file, chromo, name, pos=None):
+    f = h5.File(stats_file, 'r')
+    g = f[chromo]
+    d = {k: g[k].value for k in [name, 'pos']}
+    f.close()
+    if pos is not None:
+        t = np.in1d(d['pos'], pos)
+        for k in d.keys():
+            d[k] = d[k][t]
+        assert np.all(d['pos'] == pos)
+    return d['pos'], d[name]
+
+
+def input_paths(chromo, cpg_knn=None, seq_file=None, knn_group='knn_shared'):
+    """Files and position datasets of input features on `chromo`."""
+    paths = []
+    if cpg_knn is not None:
+        paths.extend([(x, '/%s/%s/pos' % (knn_group, chromo))
+                      for x in cpg_knn])
+    if seq_file is not None:
+        paths.append((seq_file, '/%s/pos' % (chromo)))
+    return paths
+
+
+def read_input_pos(chromo, cpg_knn=None, seq_file=None,
+                   knn_group='knn_shared'):
+    """Positions on `chromo` for which all input features are available."""
+    pos = None
+    for path, group in input_paths(chromo, cpg_knn, seq_file, knn_group):
+        f = h5.File(path, 'r')
+        p = f[group].value
+        f.close()
+        if pos is None:
+            pos = p
+        else:
+            pos = np.intersect1d(pos, p)
+    return pos
+
+
+def block_rows(chromo, blocks, cpg_knn=None, seq_file=None,
+               knn_group='knn_shared'):
+    """Rows (start, stop) of input files holding each block of sorted
+    positions in `blocks`.
+
+    Positions of each file are read once, such that blocks can be read by
+    `read_inputs` without reading the whole chromosome.
+    """
+    rows = [dict() for b in blocks]
+    for path, group in input_paths(chromo, cpg_knn, seq_file, knn_group):
+        f = h5.File(path, 'r')
+        p = f[group][:]
+        f.close()
+        for i, b in enumerate(blocks):
+            rows[i][path] = (np.searchsorted(p, b[0]),
+                             np.searchsorted(p, b[-1], side='right'))
+    return rows
+
+
+def read_inputs(chromo, pos, cpg_knn=None, seq_file=None,
+                knn_group='knn_shared', knn=None, seq_len=None, rows=None):
+    """Input features for positions `pos` on `chromo`.
+
+    `rows` maps input files to rows holding `pos`, e.g. of `block_rows`.
+    """
+    rows = rows or dict()
+    d = dict()
+    if cpg_knn is not None:
+        d['c_x'] = read_knn_all(cpg_knn, chromo=chromo, pos=pos,
+                                knn_group=knn_group, knn=knn, rows=rows)
+    if seq_file is not None:
+        d['s_x'] = encode_seqs(read_seq(seq_file, chromo, pos,
+                                        seq_len=seq_len,
+                                        rows=rows.get(seq_file)))
+    d['pos'] = pos
+    d['chromo'] = np.repeat(np.array(chromo.encode()), len(pos))
+    return d
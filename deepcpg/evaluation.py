@@ -1,5 +1,7 @@
+import multiprocessing as mp
 import pandas as pd
 import numpy as np
+import scipy.stats as sps
 import sklearn.metrics as skm
 
 
@@ -86,29 +88,434 @@ eval_funs_regress = [
     ('cor', cor)]
 
 
+def confusion(y, z, m):
+    """Returns confusion counts of rounded predictions per column."""
+    y1 = (y == 1) & m
+    y0 = (y == 0) & m
+    r = np.round(z)
+    s = dict()
+    s['tp'] = (y1 & (r == 1)).sum(axis=0)
+    s['fn'] = (y1 & (r == 0)).sum(axis=0)
+    s['tn'] = (y0 & (r == 0)).sum(axis=0)
+    s['fp'] = (y0 & (r == 1)).sum(axis=0)
+    return s
+
+
+def moments(y, z, m):
+    """Returns # samples, means, and centered (co-)moments per column."""
+    s = dict()
+    s['n'] = n = m.sum(axis=0)
+    y = np.where(m, y, 0).astype('float64')
+    z = np.where(m, z, 0).astype('float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s['my'] = my = y.sum(axis=0) / n
+        s['mz'] = mz = z.sum(axis=0) / n
+    yc = np.where(m, y - my, 0)
+    zc = np.where(m, z - mz, 0)
+    s['m2y'] = (yc**2).sum(axis=0)
+    s['m2z'] = (zc**2).sum(axis=0)
+    s['cyz'] = (yc * zc).sum(axis=0)
+    s['se'] = ((y - z)**2).sum(axis=0)
+    s['ad'] = np.abs(y - z).sum(axis=0)
+    return s
+
+
+def log_lik(y, z, m):
+    """Returns sum of binary log2-likelihoods per column."""
+    eps = 1e-6
+    t = y * np.log2(np.maximum(z, eps))
+    t += (1 - y) * np.log2(np.maximum(1 - z, eps))
+    return np.where(m, t, 0).sum(axis=0)
+
+
+def rank_auc(y, z, m):
+    """Returns AUC per column from the rank sum of positive samples."""
+    a = np.empty(y.shape[1])
+    for i in range(y.shape[1]):
+        yi = y[m[:, i], i] == 1
+        n1 = yi.sum()
+        n0 = len(yi) - n1
+        if n1 == 0 or n0 == 0:
+            a[i] = np.nan
+            continue
+        r = sps.rankdata(z[m[:, i], i])
+        a[i] = (r[yi].sum() - n1 * (n1 + 1) / 2) / (n1 * n0)
+    return a
+
+
+def _div(a, b):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.asarray(a, dtype='float64') / b
+
+
+def _tpr(s):
+    p = s['tp'] + s['fn']
+    return np.where(p > 0, _div(s['tp'], p), 0)
+
+
+def _tnr(s):
+    # Only positive labels and predictions have specificity one
+    t = s['tn'] + s['fp'] + s['fn'] == 0
+    return np.where(t, 1, _div(s['tn'], s['tn'] + s['fp']))
+
+
+def _mcc(s):
+    tp, fp, tn, fn = [s[k].astype('float64') for k in ['tp', 'fp', 'tn', 'fn']]
+    d = np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+    return np.where(d > 0, _div(tp * tn - fp * fn, d), 0)
+
+
+def _cor(s):
+    c = _div(s['cyz'], np.sqrt(s['m2y'] * s['m2z']))
+    return np.clip(c, -1, 1)
+
+
+# Metrics computed from the statistics of `moments`, `confusion`, and
+# `rank_auc` instead of calling the metric function for each target
+stat_funs = {
+    auc: lambda s: s['auc'],
+    acc: lambda s: _div(s['tp'] + s['tn'], s['n']),
+    tpr: _tpr,
+    tnr: _tnr,
+    mcc: _mcc,
+    nll: lambda s: -_div(s['ll'], s['n']),
+    mse: lambda s: _div(s['se'], s['n']),
+    rmse: lambda s: np.sqrt(_div(s['se'], s['n'])),
+    rrmse: lambda s: 1 - np.sqrt(_div(s['se'], s['n'])),
+    mad: lambda s: _div(s['ad'], s['n']),
+    cor: _cor
+}
+
+
+def _mask(y, mask):
+    if mask is not None:
+        return y != mask
+    return np.ones(y.shape, dtype='bool')
+
+
+def batch_stats(y, z, m, funs=eval_funs):
+    """Returns statistics of columns needed for evaluating `funs`."""
+    s = moments(y, z, m)
+    names = [fun for _, fun in funs]
+    if len(set(names) & set([acc, tpr, tnr, mcc])):
+        s.update(confusion(y, z, m))
+    if nll in names:
+        s['ll'] = log_lik(y, z, m)
+    return s
+
+
+def evaluate_batch(y, z, mask=-1, funs=eval_funs):
+    """Evaluates columns of `y` and `z` as separate targets.
+
+    Thresholded metrics share one set of confusion counts and AUC is computed
+    from one sort per column.
+    """
+    y = np.asarray(y)
+    z = np.asarray(z)
+    m = _mask(y, mask)
+    s = batch_stats(y, z, m, funs)
+    if auc in [fun for _, fun in funs]:
+        s['auc'] = rank_auc(y, z, m)
+    d = pd.DataFrame(index=range(y.shape[1]))
+    for name, fun in funs:
+        if fun in stat_funs:
+            d[name] = stat_funs[fun](s)
+        else:
+            d[name] = [fun(y[m[:, i], i], z[m[:, i], i])
+                       for i in range(y.shape[1])]
+    d.loc[s['n'] == 0, [x for x, _ in funs]] = np.nan
+    d['n'] = s['n']
+    return d
+
+
 def evaluate(y, z, mask=-1, funs=eval_funs):
-    y = y.ravel()
-    z = z.ravel()
+    return evaluate_batch(y.reshape(-1, 1), z.reshape(-1, 1), mask, funs)
+
+
+_batch = None
+
+
+def _evaluate_columns(cols):
+    y, z, kwargs = _batch
+    return evaluate_batch(y[:, cols], z[:, cols], **kwargs)
+
+
+def weighted_stats(y, z, w, funs=eval_funs):
+    """Returns statistics of `batch_stats` for each row of sample weights
+    `w`, e.g. bootstrap resample counts."""
+    names = [fun for _, fun in funs]
+    yc = y - y.mean()
+    zc = z - z.mean()
+    x = [np.ones(len(y)), yc, zc, yc**2, zc**2, yc * zc, (y - z)**2,
+         np.abs(y - z)]
+    keys = ['n', 'sy', 'sz', 'syy', 'szz', 'syz', 'se', 'ad']
+    if len(set(names) & set([acc, tpr, tnr, mcc])):
+        r = np.round(z)
+        x.extend([(y == 1) & (r == 1), (y == 1) & (r == 0),
+                  (y == 0) & (r == 0), (y == 0) & (r == 1)])
+        keys.extend(['tp', 'fn', 'tn', 'fp'])
+    if nll in names:
+        eps = 1e-6
+        x.append(y * np.log2(np.maximum(z, eps)) +
+                 (1 - y) * np.log2(np.maximum(1 - z, eps)))
+        keys.append('ll')
+    # Weighted sums of all statistics as one matrix product
+    t = np.dot(w, np.column_stack(x).astype('float64'))
+    s = {k: t[:, i] for i, k in enumerate(keys)}
+    n = s['n']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s['m2y'] = s['syy'] - s['sy']**2 / n
+        s['m2z'] = s['szz'] - s['sz']**2 / n
+        s['cyz'] = s['syz'] - s['sy'] * s['sz'] / n
+    if auc in names and len(y) == 0:
+        s['auc'] = np.repeat(np.nan, len(w))
+    elif auc in names:
+        # Samples are sorted once and grouped by tied predictions
+        o = np.argsort(z, kind='mergesort')
+        zo = z[o]
+        starts = np.nonzero(np.hstack(([True], zo[1:] != zo[:-1])))[0]
+        pos = y[o] == 1
+        wo = w[:, o]
+        h1 = np.add.reduceat(wo * pos, starts, axis=1)
+        h0 = np.add.reduceat(wo * ~pos, starts, axis=1)
+        below = np.cumsum(h0, axis=1) - h0
+        n1 = h1.sum(axis=1)
+        n0 = h0.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            a = (h1 * (below + 0.5 * h0)).sum(axis=1) / (n1 * n0)
+        a[(n1 == 0) | (n0 == 0)] = np.nan
+        s['auc'] = a
+    return s
+
+
+def _bootstrap_block(block):
+    y, z, funs = _batch
+    seed, size = block
+    rng = np.random.RandomState(seed)
+    w = rng.poisson(1, (size, len(y))).astype('float64')
+    s = weighted_stats(y, z, w, funs)
+    e = np.column_stack([stat_funs[fun](s) for _, fun in funs])
+    e[s['n'] == 0] = np.nan
+    return e
+
+
+def bootstrap(y, z, mask=-1, funs=eval_funs, nb_boot=1000, alpha=0.05,
+              nb_worker=1, seed=0, block_size=10**7):
+    """Returns percentile bootstrap confidence intervals of `funs`.
+
+    Resamples are drawn as Poisson(1) sample weights and evaluated in blocks
+    of at most `block_size` weights, which are distributed over `nb_worker`
+    forked processes. Returns DataFrame with `_lo` and `_hi` column of each
+    metric, which are NaN without labels or with labels of one class.
+    """
+    global _batch
+    for name, fun in funs:
+        if fun not in stat_funs:
+            raise ValueError('Metric %s can not be bootstrapped!' % (name))
+    y = np.ravel(y)
+    z = np.ravel(z)
     if mask is not None:
         t = y != mask
         y = y[t]
         z = z[t]
-    s = dict()
-    for name, fun in funs:
-        s[name] = fun(y, z)
-    d = pd.DataFrame(s, columns=[x for x, _ in funs], index=[0])
-    d['n'] = len(y)
+    y = y.astype('float64')
+    z = z.astype('float64')
+    d = pd.DataFrame(index=[0])
+    if len(np.unique(y)) < 2:
+        for name, _ in funs:
+            d[name + '_lo'] = d[name + '_hi'] = np.nan
+        return d
+    size = max(1, min(nb_boot, block_size // max(1, len(y))))
+    blocks = [(seed + i, min(size, nb_boot - j))
+              for i, j in enumerate(range(0, nb_boot, size))]
+    _batch = (y, z, funs)
+    if nb_worker > 1 and len(blocks) > 1:
+        pool = mp.get_context('fork').Pool(min(nb_worker, len(blocks)))
+        e = pool.map(_bootstrap_block, blocks)
+        pool.close()
+        pool.join()
+    else:
+        e = [_bootstrap_block(b) for b in blocks]
+    _batch = None
+    e = np.vstack(e)
+    with np.errstate(invalid='ignore'):
+        for i, (name, _) in enumerate(funs):
+            x = e[:, i][~np.isnan(e[:, i])]
+            if len(x) == 0:
+                d[name + '_lo'] = d[name + '_hi'] = np.nan
+            else:
+                d[name + '_lo'] = np.percentile(x, 100 * alpha / 2)
+                d[name + '_hi'] = np.percentile(x, 100 * (1 - alpha / 2))
     return d
 
 
-def evaluate_all(y, z, *args, **kwargs):
+def evaluate_all(y, z, mask=-1, funs=eval_funs, nb_worker=1, nb_column=8,
+                 nb_boot=0, alpha=0.05):
+    """Evaluates all targets of `z`.
+
+    Targets with the same # samples are evaluated in batches of `nb_column`
+    targets, which are distributed over `nb_worker` forked processes.
+    If `nb_boot`, adds `1 - alpha` bootstrap confidence intervals of
+    metrics as `_lo` and `_hi` columns.
+    """
+    global _batch
     keys = sorted(z.keys())
-    p = [evaluate(y[k][:], z[k][:], *args, **kwargs) for k in keys]
+    ys = [np.ravel(y[k][:]) for k in keys]
+    zs = [np.ravel(z[k][:]) for k in keys]
+    p = []
+    for n in np.unique([len(x) for x in ys]):
+        idx = [i for i in range(len(keys)) if len(ys[i]) == n]
+        _batch = (np.column_stack([ys[i] for i in idx]),
+                  np.column_stack([zs[i] for i in idx]),
+                  {'mask': mask, 'funs': funs})
+        cols = [list(range(i, min(i + nb_column, len(idx))))
+                for i in range(0, len(idx), nb_column)]
+        if nb_worker > 1 and len(cols) > 1:
+            pool = mp.get_context('fork').Pool(min(nb_worker, len(cols)))
+            e = pool.map(_evaluate_columns, cols)
+            pool.close()
+            pool.join()
+        else:
+            e = [_evaluate_columns(c) for c in cols]
+        e = pd.concat(e)
+        e.index = [keys[i] for i in idx]
+        p.append(e)
+    _batch = None
     p = pd.concat(p)
-    p.index = keys
+    p = p.loc[keys]
+    if nb_boot:
+        ci = [bootstrap(y[k][:], z[k][:], mask, funs, nb_boot, alpha,
+                        nb_worker) for k in keys]
+        ci = pd.concat(ci)
+        ci.index = keys
+        p = pd.concat([p, ci], axis=1)
     return p
 
 
+class StreamEvaluator(object):
+    """Evaluates `targets` from batches of labels and predictions.
+
+    Statistics are accumulated by `update` and can be combined with `merge`,
+    e.g. over workers or chromosomes. AUC is approximated from histograms of
+    predictions with `nb_bin` bins in [0, 1], or computed exactly from all
+    predictions if `nb_bin` is 0.
+    """
+
+    def __init__(self, targets, mask=-1, funs=eval_funs, nb_bin=0):
+        for name, fun in funs:
+            if fun not in stat_funs:
+                raise ValueError('Metric %s can not be accumulated!' % (name))
+        self.targets = list(targets)
+        self.mask = mask
+        self.funs = funs
+        self.nb_bin = nb_bin
+        nb_target = len(self.targets)
+        self.stats = dict()
+        for k in ['n', 'tp', 'fn', 'tn', 'fp']:
+            self.stats[k] = np.zeros(nb_target, dtype='int64')
+        for k in ['my', 'mz', 'm2y', 'm2z', 'cyz', 'se', 'ad', 'll']:
+            self.stats[k] = np.zeros(nb_target)
+        if nb_bin:
+            self.hist = np.zeros((2, nb_target, nb_bin), dtype='int64')
+        else:
+            self.scores = [([], []) for i in range(nb_target)]
+
+    def update(self, y, z):
+        """Adds labels `y` and predictions `z`, which are dicts of targets."""
+        y = np.column_stack([np.ravel(y[k]) for k in self.targets])
+        z = np.column_stack([np.ravel(z[k]) for k in self.targets])
+        m = _mask(y, self.mask)
+        self._merge_stats(batch_stats(y, z, m, self.funs))
+        if auc not in [fun for _, fun in self.funs]:
+            return
+        if self.nb_bin:
+            b = np.clip(z * self.nb_bin, 0, self.nb_bin - 1).astype('int')
+            b += np.arange(len(self.targets)) * self.nb_bin
+        for label in [0, 1]:
+            t = m & (y == label)
+            if self.nb_bin:
+                h = np.bincount(b[t], minlength=b.shape[1] * self.nb_bin)
+                self.hist[label] += h.reshape(-1, self.nb_bin)
+            else:
+                for i in range(len(self.targets)):
+                    self.scores[i][label].append(z[t[:, i], i])
+
+    def merge(self, other):
+        """Adds statistics of StreamEvaluator `other`."""
+        if other.targets != self.targets:
+            raise ValueError('Targets do not match!')
+        self._merge_stats(other.stats)
+        if self.nb_bin:
+            self.hist += other.hist
+        else:
+            for i in range(len(self.targets)):
+                for label in [0, 1]:
+                    self.scores[i][label].extend(other.scores[i][label])
+
+    def _merge_stats(self, s):
+        a = self.stats
+        na = a['n']
+        nb = s['n']
+        n = na + nb
+        with np.errstate(invalid='ignore', divide='ignore'):
+            w = np.where(n > 0, nb / n, 0)
+            f = np.where(n > 0, na * nb / n, 0)
+        # Pairwise update of means and centered (co-)moments
+        dy = np.where(nb > 0, s['my'], 0) - a['my']
+        dz = np.where(nb > 0, s['mz'], 0) - a['mz']
+        a['my'] = a['my'] + dy * w
+        a['mz'] = a['mz'] + dz * w
+        a['m2y'] = a['m2y'] + s['m2y'] + dy**2 * f
+        a['m2z'] = a['m2z'] + s['m2z'] + dz**2 * f
+        a['cyz'] = a['cyz'] + s['cyz'] + dy * dz * f
+        for k in ['se', 'ad', 'll', 'tp', 'fn', 'tn', 'fp']:
+            if k in s:
+                a[k] = a[k] + s[k]
+        a['n'] = n
+
+    def auc(self):
+        if not self.nb_bin:
+            a = np.empty(len(self.targets))
+            for i, (neg, pos) in enumerate(self.scores):
+                neg = np.hstack([[]] + neg)
+                pos = np.hstack([[]] + pos)
+                y = np.hstack([np.zeros(len(neg)), np.ones(len(pos))])
+                z = np.hstack([neg, pos])
+                m = np.ones((len(y), 1), dtype='bool')
+                a[i] = rank_auc(y.reshape(-1, 1), z.reshape(-1, 1), m)[0]
+            return a
+        h0, h1 = self.hist
+        n0 = h0.sum(axis=1)
+        n1 = h1.sum(axis=1)
+        # Positives are ranked above negatives of lower bins and tie with
+        # negatives of the same bin
+        below = np.cumsum(h0, axis=1) - h0
+        a = (h1 * (below + 0.5 * h0)).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            a = a / (n1 * n0)
+        a[(n1 == 0) | (n0 == 0)] = np.nan
+        return a
+
+    def evaluate(self):
+        s = dict(self.stats)
+        if auc in [fun for _, fun in self.funs]:
+            s['auc'] = self.auc()
+        d = pd.DataFrame(index=self.targets)
+        for name, fun in self.funs:
+            d[name] = stat_funs[fun](s)
+        d.loc[s['n'] == 0, [x for x, _ in self.funs]] = np.nan
+        d['n'] = s['n']
+        return d
+
+    def batch_callback(self, data):
+        """Returns callback of `predict_loop` that adds batches of
+        predictions and labels of `data`."""
+        def update(batch_start, batch_end, z):
+            y = {k: data[k][batch_start:batch_end] for k in self.targets}
+            self.update(y, z)
+        return update
+
+
 def eval_to_str(e, index=False, *args, **kwargs):
     s = e.to_csv(None, sep='\t', index=index, float_format='%.4f', *args,
                  **kwargs)
@@ -1,6 +1,9 @@
 import h5py as h5
 import numpy as np
+import os
 import re
+from time import time
+from collections import OrderedDict
 
 
 MASK = -1
@@ -74,6 +77,271 @@ def write_z(data, z, targets, out_file, unlabeled=False, name='z',
     f.close()
 
 
+def quantize(z, dtype):
+    if dtype == 'uint8':
+        return np.round(np.clip(z, 0, 1) * 255).astype('uint8')
+    return np.asarray(z, dtype=dtype)
+
+
+def dequantize(z):
+    if z.dtype == np.uint8:
+        return z.astype('float32') / 255
+    return z.astype('float32')
+
+
+def extra_dtype(dtype):
+    # Variances are too small to be stored as uint8
+    if dtype == 'uint8':
+        return 'float16'
+    return dtype
+
+
+class BlockWriter(object):
+    """Writes HDF datasets block-wise.
+
+    Datasets grow with each block. Committing a block records their sizes
+    and the block id, such that writing can be resumed after the last
+    committed block if interrupted. Keyword arguments are stored as file
+    attributes and must match when resuming. Without `resume`, an existing
+    file is overwritten.
+    """
+
+    def __init__(self, path, resume=False, compression=None, **kwargs):
+        self.compression = compression
+        if resume and os.path.isfile(path):
+            self.file = h5.File(path, 'a')
+            for k, v in kwargs.items():
+                if self.file.attrs.get(k) != v:
+                    raise ValueError('%s of %s differs from %s!' %
+                                     (k, path, str(v)))
+            self._rollback()
+            self.done = set(self.file.attrs.get('blocks_done', []))
+        else:
+            self.file = h5.File(path, 'w')
+            for k, v in kwargs.items():
+                self.file.attrs[k] = v
+            self.done = set()
+        self._written = set()
+
+    def _rollback(self):
+        def truncate(name, obj):
+            if isinstance(obj, h5.Dataset):
+                obj.resize(obj.attrs.get('size', 0), axis=0)
+        self.file.visititems(truncate)
+
+    def _append(self, group, name, x):
+        if name not in group:
+            t = int(np.prod(x.shape[1:]))
+            chunks = (max(1, min(2**14, 2**16 // t)),) + x.shape[1:]
+            group.create_dataset(name, shape=(0,) + x.shape[1:],
+                                 maxshape=(None,) + x.shape[1:],
+                                 dtype=x.dtype, chunks=chunks,
+                                 compression=self.compression,
+                                 shuffle=self.compression is not None)
+        d = group[name]
+        n = d.shape[0]
+        d.resize(n + len(x), axis=0)
+        d[n:] = x
+        self._written.add(d.name)
+        return d
+
+    def commit(self, block):
+        for name in self._written:
+            d = self.file[name]
+            d.attrs['size'] = d.shape[0]
+        self._written = set()
+        self.done.add(block)
+        self.file.attrs['blocks_done'] = np.array(sorted(self.done),
+                                                  dtype='int64')
+        self.file.flush()
+
+    def _sort(self, group):
+        pos = group['pos'][:]
+        if np.all(pos[:-1] < pos[1:]):
+            return
+        t = np.argsort(pos)
+        assert np.all(np.diff(pos[t]) > 0)
+        for k in group.keys():
+            group[k][:] = group[k][:][t]
+
+    def close(self):
+        self.file.close()
+
+
+class ZWriter(BlockWriter):
+    """Writes predictions block-wise in the layout of write_z."""
+
+    def __init__(self, path, targets, name='z', unlabeled=False,
+                 dtype='float32', *args, **kwargs):
+        super(ZWriter, self).__init__(path, *args, **kwargs)
+        self.target_map = dict()
+        for x in zip(targets['id'], targets['name']):
+            self.target_map[x[0] + '_y'] = x[1]
+        self.name = name
+        self.unlabeled = unlabeled
+        self.dtype = dtype
+
+    def write(self, data, z, extra=dict()):
+        """Writes predictions `z` and further predictions `extra`, which
+        maps dataset names to predictions, e.g. of variances."""
+        for target in z.keys():
+            d = dict()
+            d[self.name] = quantize(np.ravel(z[target]), self.dtype)
+            for name, v in extra.items():
+                d[name] = quantize(np.ravel(v[target]),
+                                   extra_dtype(self.dtype))
+            d['y'] = np.ravel(data[target][:])
+            d['pos'] = data['pos'][:]
+            d['chromo'] = data['chromo'][:]
+            if not self.unlabeled:
+                t = d['y'] != MASK
+                for k in d.keys():
+                    d[k] = d[k][t]
+
+            gt = self.file.require_group(self.target_map[target])
+            for chromo in np.unique(d['chromo']):
+                t = d['chromo'] == chromo
+                gtc = gt.require_group(chromo)
+                for k in [self.name, 'y', 'pos'] + list(extra.keys()):
+                    self._append(gtc, k, d[k][t])
+
+    def close(self):
+        for gt in self.file.values():
+            for gtc in gt.values():
+                self._sort(gtc)
+        super(ZWriter, self).close()
+
+
+class ZMatrixWriter(BlockWriter):
+    """Writes predictions block-wise as sites x targets matrices.
+
+    Each chromosome group holds one `pos` vector and matrices `y` and `z`,
+    whose columns are the targets listed in the `targets` file attribute.
+    """
+
+    def __init__(self, path, targets, name='z', unlabeled=False,
+                 dtype='float32', *args, **kwargs):
+        super(ZMatrixWriter, self).__init__(path, *args, **kwargs)
+        self.ids = [x + '_y' for x in targets['id']]
+        self.file.attrs['targets'] = np.array([x.encode()
+                                               for x in targets['name']])
+        self.name = name
+        self.unlabeled = unlabeled
+        self.dtype = dtype
+
+    def write(self, data, z, extra=dict()):
+        ids = [x for x in self.ids if x in z]
+        if len(ids) != len(self.ids):
+            raise ValueError('Predictions of all targets required!')
+        d = dict()
+        d[self.name] = quantize(np.column_stack([z[x] for x in ids]),
+                                self.dtype)
+        for name, v in extra.items():
+            d[name] = quantize(np.column_stack([v[x] for x in ids]),
+                               extra_dtype(self.dtype))
+        d['y'] = np.column_stack([data[x][:] for x in ids])
+        d['pos'] = data['pos'][:]
+        d['chromo'] = data['chromo'][:]
+        if not self.unlabeled:
+            t = np.any(d['y'] != MASK, axis=1)
+            for k in d.keys():
+                d[k] = d[k][t]
+        for chromo in np.unique(d['chromo']):
+            t = d['chromo'] == chromo
+            g = self.file.require_group(chromo)
+            for k in [self.name, 'y', 'pos'] + list(extra.keys()):
+                self._append(g, k, d[k][t])
+
+    def close(self):
+        for g in self.file.values():
+            self._sort(g)
+        super(ZMatrixWriter, self).close()
+
+
+def read_zm(path, chromo, name='z'):
+    f = h5.File(path, 'r')
+    g = f[chromo]
+    d = {k: g[k][:] for k in ['pos', 'y', name]}
+    d[name] = dequantize(d[name])
+    targets = [x.decode() for x in f.attrs['targets']]
+    f.close()
+    return (d, targets)
+
+
+class AnnoIndex(object):
+    """Bitset index of annotations of sites written by anno_index.py.
+
+    Each chromosome group holds sorted `pos` and `bits`, whose rows are the
+    annotations of sites packed by `np.packbits`.
+    """
+
+    def __init__(self, path):
+        self.file = h5.File(path, 'r')
+        self.names = [x.decode() for x in self.file.attrs['annos']]
+        self._chromo = None
+
+    def _load(self, chromo):
+        if isinstance(chromo, bytes):
+            chromo = chromo.decode()
+        if chromo != self._chromo:
+            self._chromo = chromo
+            if chromo in self.file:
+                self._pos = self.file[chromo]['pos'][:]
+                self._bits = self.file[chromo]['bits'][:]
+            else:
+                self._pos = np.empty(0, dtype='int32')
+                self._bits = None
+
+    def lookup(self, chromo, pos):
+        """Returns boolean matrix whether sites are in annotations.
+
+        `chromo` is a single chromosome or one chromosome per site. Sites
+        missing in the index are not in any annotation.
+        """
+        pos = np.asarray(pos)
+        annos = np.zeros((len(pos), len(self.names)), dtype='bool')
+        chromo = np.asarray(chromo)
+        if chromo.ndim == 0:
+            chromos = [chromo.item()]
+        else:
+            chromos = np.unique(chromo)
+        for c in chromos:
+            if chromo.ndim == 0:
+                t = np.arange(len(pos))
+            else:
+                t = np.nonzero(chromo == c)[0]
+            self._load(c)
+            if len(self._pos) == 0:
+                continue
+            i = np.minimum(np.searchsorted(self._pos, pos[t]),
+                           len(self._pos) - 1)
+            found = self._pos[i] == pos[t]
+            bits = np.unpackbits(self._bits[i[found]], axis=1)
+            annos[t[found]] = bits[:, :len(self.names)]
+        return annos
+
+    def close(self):
+        self.file.close()
+
+
+def read_weights(path):
+    f = h5.File(path, 'r')
+    g = f['graph']
+    weights = [g['param_%d' % (i)][:] for i in range(g.attrs['nb_params'])]
+    f.close()
+    return weights
+
+
+def write_weights(path, weights):
+    """Writes weights in the format of Graph.save_weights."""
+    f = h5.File(path, 'w')
+    g = f.create_group('graph')
+    g.attrs['nb_params'] = len(weights)
+    for i, w in enumerate(weights):
+        g.create_dataset('param_%d' % (i), data=w)
+    f.close()
+
+
 def open_hdf(filename, acc='r', cache_size=None):
     if cache_size:
         propfaid = h5.h5p.create(h5.h5p.FILE_ACCESS)
@@ -87,6 +355,101 @@ def open_hdf(filename, acc='r', cache_size=None):
     return _file
 
 
+class CsrLabels(object):
+    """Labels stored as CSR matrix in HDF group with datasets `indptr`,
+    `indices` (targets), and `data` (labels).
+
+    Columns are densified with MASK for missing labels when read. Sparse
+    labels of the last `nb_cache` row ranges are cached, such that reading
+    all targets of a batch reads them once.
+    """
+
+    def __init__(self, group, nb_target, nb_cache=16):
+        self.group = group
+        self.shape = (group['indptr'].shape[0] - 1, nb_target)
+        self.dtype = group['data'].dtype
+        self.chunks = group['indptr'].chunks
+        self.nb_cache = nb_cache
+        self._cache = OrderedDict()
+
+    def rows(self, start, stop):
+        """Returns row offsets, targets, and labels of rows start:stop."""
+        key = (start, stop)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        p = self.group['indptr'][start:stop + 1]
+        rows = np.repeat(np.arange(stop - start), np.diff(p))
+        csr = (rows, self.group['indices'][p[0]:p[-1]],
+               self.group['data'][p[0]:p[-1]])
+        self._cache[key] = csr
+        if len(self._cache) > self.nb_cache:
+            self._cache.popitem(last=False)
+        return csr
+
+    def dense(self, col, start, stop):
+        rows, indices, data = self.rows(start, stop)
+        x = np.empty(stop - start, dtype=self.dtype)
+        x.fill(MASK)
+        t = indices == col
+        x[rows[t]] = data[t]
+        return x
+
+    def column(self, col):
+        return CsrColumn(self, col)
+
+
+class CsrColumn(object):
+    """Column `col` of CsrLabels as dense (N, 1) dataset."""
+
+    def __init__(self, labels, col):
+        self.labels = labels
+        self.col = col
+        self.shape = (labels.shape[0], 1)
+        self.dtype = labels.dtype
+        self.chunks = labels.chunks
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            rest = key[1:]
+            key = key[0]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            x = self.labels.dense(self.col, start, max(start, stop))[::step]
+        elif isinstance(key, (int, np.integer)):
+            x = self.labels.dense(self.col, key, key + 1)
+        else:
+            key = np.asarray(key)
+            if key.dtype == bool:
+                key = np.nonzero(key)[0]
+            if len(key) == 0:
+                x = np.empty(0, dtype=self.dtype)
+            else:
+                start = key.min()
+                x = self.labels.dense(self.col, start, key.max() + 1)
+                x = x[key - start]
+        x = x.reshape(-1, 1)
+        if len(rest):
+            x = x[(slice(None),) + rest]
+        if isinstance(key, (int, np.integer)):
+            x = x[0]
+        return x
+
+
+def read_labels(f, data):
+    """Adds columns of sparse labels of data file `f` to `data`."""
+    if 'labels' not in f:
+        return
+    ids = [x.decode() for x in f['targets/id'].value]
+    labels = CsrLabels(f['labels'], len(ids))
+    for i, target_id in enumerate(ids):
+        data['%s_y' % (target_id)] = labels.column(i)
+
+
 def read_data(path, max_mem=None):
     f = open_hdf(path, cache_size=max_mem)
     data = dict()
@@ -94,6 +457,7 @@ def read_data(path, max_mem=None):
         data[k] = v
     for k, v in f['pos'].items():
         data[k] = v
+    read_labels(f, data)
     return (f, data)
 
 
@@ -104,9 +468,39 @@ def read_hdf(path, cache_size):
         data[k] = v
     for k, v in f['pos'].items():
         data[k] = v
+    read_labels(f, data)
     return (f, data)
 
 
+def read_coverage(f, outputs, chunk_size=10**6):
+    """Returns index of rows of data file `f` with a label for any of
+    `outputs`, or None if `f` has no label-coverage index."""
+    if 'index' not in f or 'cov' not in f['index']:
+        return None
+    ids = [x.decode() for x in f['targets/id'].value]
+    cols = [ids.index(x.replace('_y', '')) for x in outputs]
+    cov = f['index/cov']
+    index = []
+    for i in range(0, cov.shape[0], chunk_size):
+        h = np.unpackbits(cov[i:i + chunk_size], axis=1)[:, cols]
+        index.append(i + np.nonzero(h.any(axis=1))[0])
+    return np.concatenate(index)
+
+
+def stratified_index(chromos, nb_sample):
+    """Random sorted row index with rows of chromosomes `chromos` in equal
+    proportions as in all rows."""
+    chromos = chromos[:]
+    if nb_sample >= len(chromos):
+        return np.arange(len(chromos))
+    idx = []
+    for chromo in np.unique(chromos):
+        t = np.nonzero(chromos == chromo)[0]
+        k = int(round(nb_sample * len(t) / len(chromos)))
+        idx.append(np.random.choice(t, min(k, len(t)), replace=False))
+    return np.sort(np.concatenate(idx))
+
+
 def to_view(d, *args, **kwargs):
     for k in d.keys():
         d[k] = ArrayView(d[k], *args, **kwargs)
@@ -146,16 +540,37 @@ def select_region(chromos, pos, chromo=None, start=None, stop=None,
 
 
 class ArrayView(object):
+    """View of rows `start` to `stop` of `data`, or of rows `index` of
+    `data` if given."""
 
-    def __init__(self, data, start=0, stop=None):
+    def __init__(self, data, start=0, stop=None, index=None):
         self.start = start
+        self.index = index
         if stop is None:
-            stop = data.shape[0]
+            stop = self._size(data)
         else:
-            stop = min(stop, data.shape[0])
+            stop = min(stop, self._size(data))
         self.stop = stop
         self.data = data
 
+    def _size(self, data):
+        if self.index is None:
+            return data.shape[0]
+        return len(self.index)
+
+    def _map(self, idx):
+        if self.index is None:
+            return idx
+        rows = self.index[idx]
+        if isinstance(idx, slice):
+            if len(rows) and rows[-1] - rows[0] == len(rows) - 1:
+                # Contiguous rows are faster read as slice
+                return slice(rows[0], rows[-1] + 1)
+            return rows.tolist()
+        elif isinstance(idx, list):
+            return rows.tolist()
+        return int(rows)
+
     def __len__(self):
         return self.stop - self.start
 
@@ -200,12 +615,179 @@ class ArrayView(object):
             idx = tuple(idx)
         else:
             idx = self._adapt_key(key)
+        if isinstance(idx, tuple):
+            idx = (self._map(idx[0]),) + idx[1:]
+        else:
+            idx = self._map(idx)
         return self.data[idx]
 
     def use_all(self):
         self.start = 0
-        self.stop = self.data.shape[0]
+        self.stop = self._size(self.data)
 
     @property
     def shape(self):
         return tuple([len(self)] + list(self.data.shape[1:]))
+
+
+class ChunkSampler(object):
+    """Samples rows of HDF datasets in random order at sequential read speed.
+
+    Each epoch, chunks of `chunk_size` rows are permuted over the whole
+    file. Groups of `nb_buffer` chunks are read into a buffer, whose rows are
+    shuffled. Views returned by `view` index the rows sampled in an epoch,
+    which must be read in order, e.g. by `fit` with shuffle=False.
+
+    If `index` is given, only rows `index` are sampled, e.g. of
+    `read_coverage`. Chunks are then chunks of `index`, whose rows are read
+    as one slice and filtered.
+    """
+
+    def __init__(self, data, nb_sample=None, chunk_size=None, nb_buffer=8,
+                 index=None):
+        self.data = data
+        self.index = index
+        if index is None:
+            self._n = list(data.values())[0].shape[0]
+        else:
+            self._n = len(index)
+        if chunk_size is None:
+            chunk_size = 2**14
+            for v in data.values():
+                if getattr(v, 'chunks', None):
+                    chunk_size = v.chunks[0]
+                    break
+        self.chunk_size = chunk_size
+        self.nb_buffer = nb_buffer
+        if nb_sample is None:
+            nb_sample = self._n
+        self.nb_sample = min(self._n, nb_sample)
+        self.shuffle()
+
+    def shuffle(self):
+        chunks = np.random.permutation(
+            int(np.ceil(self._n / self.chunk_size)))
+        sizes = np.minimum(self.chunk_size,
+                           self._n - chunks * self.chunk_size)
+        # Only read as many chunks as needed for nb_sample rows
+        sizes = np.cumsum(sizes)
+        k = np.searchsorted(sizes, self.nb_sample) + 1
+        self._chunks = chunks[:k]
+        self._starts = np.hstack(([0], sizes[:k]))[::self.nb_buffer]
+        self._buffers = dict()
+
+    def _load(self, b):
+        if b in self._buffers:
+            return self._buffers[b]
+        # Keep previous buffer for batches overlapping two buffers
+        for k in list(self._buffers.keys()):
+            if k < b - 1:
+                del self._buffers[k]
+        chunks = self._chunks[b * self.nb_buffer:(b + 1) * self.nb_buffer]
+        chunks = np.sort(chunks) * self.chunk_size
+        buf = dict()
+        for name, v in self.data.items():
+            buf[name] = np.concatenate([self._read(v, i) for i in chunks])
+        t = np.random.permutation(len(list(buf.values())[0]))
+        for name in buf.keys():
+            buf[name] = buf[name][t]
+        self._buffers[b] = buf
+        return buf
+
+    def _read(self, v, i):
+        if self.index is None:
+            return v[i:i + self.chunk_size]
+        rows = self.index[i:i + self.chunk_size]
+        return v[rows[0]:rows[-1] + 1][rows - rows[0]]
+
+    def get(self, name, idx):
+        """Returns rows `idx` of the current epoch of dataset `name`."""
+        idx = np.asarray(idx)
+        if len(idx) and (idx.min() < 0 or idx.max() >= self.nb_sample):
+            raise IndexError
+        v = self.data[name]
+        x = np.empty((len(idx),) + v.shape[1:], dtype=v.dtype)
+        bufs = np.searchsorted(self._starts, idx, side='right') - 1
+        for b in np.unique(bufs):
+            t = bufs == b
+            x[t] = self._load(b)[name][idx[t] - self._starts[b]]
+        return x
+
+    def view(self, name):
+        return SamplerView(self, name)
+
+
+class SamplerView(object):
+    """Rows of dataset `name` sampled by ChunkSampler `sampler`."""
+
+    def __init__(self, sampler, name):
+        self.sampler = sampler
+        self.name = name
+
+    def __len__(self):
+        return self.sampler.nb_sample
+
+    @property
+    def shape(self):
+        shape = self.sampler.data[self.name].shape
+        return tuple([len(self)] + list(shape[1:]))
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            rest = key[1:]
+            key = key[0]
+        if isinstance(key, slice):
+            idx = np.arange(*key.indices(len(self)))
+        elif isinstance(key, int):
+            idx = [key]
+        else:
+            idx = key
+        x = self.sampler.get(self.name, idx)
+        if len(rest):
+            x = x[(slice(None),) + rest]
+        if isinstance(key, int):
+            x = x[0]
+        return x
+
+
+class TimedView(object):
+    """Accumulates time spent reading from `data` in `elapsed`."""
+
+    def __init__(self, data):
+        self.data = data
+        self.elapsed = 0.0
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __getitem__(self, key):
+        t = time()
+        x = self.data[key]
+        self.elapsed += time() - t
+        return x
+
+
+class WeightView(ArrayView):
+    """Sample weights computed from labels `data` when indexed.
+
+    Weights are 0 for masked labels, `class_weights[c]` for labels c if
+    given, and 1 otherwise.
+    """
+
+    def __init__(self, data, class_weights=None, *args, **kwargs):
+        super(WeightView, self).__init__(data, *args, **kwargs)
+        self.class_weights = class_weights
+
+    def __getitem__(self, key):
+        y = super(WeightView, self).__getitem__(key)
+        w = np.ones(y.shape, dtype='float16')
+        if self.class_weights is not None:
+            for k, v in self.class_weights.items():
+                w[y == k] = v
+        w[y == MASK] = 0
+        return w
@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class Mutagenesis(object):
+    """Effects of all single-nucleotide substitutions in sequence windows.
+
+    Substitutions only change the first sequence convolution of a
+    NumPy model (npnet.Model) in the columns that see the mutated position,
+    which are updated incrementally from the reference. Outputs of nodes
+    that do not depend on the sequence, e.g. of the CpG module, are
+    computed once per site and shared by all its variants.
+    """
+
+    def __init__(self, model, win_len=None, batch_size=1024):
+        self.model = model
+        self.win_len = win_len
+        self.batch_size = batch_size
+        self.conv = model.seq_conv()
+        if self.conv is None:
+            raise ValueError('Model has no sequence convolution!')
+        self.static = model.static_nodes('s_x')
+        self.outputs = [model.outputs[x] for x in model.output_order]
+
+    def window(self, seq_len):
+        if self.win_len is None or self.win_len >= seq_len:
+            return (0, seq_len)
+        start = (seq_len - self.win_len) // 2
+        return (start, start + self.win_len)
+
+    def _predict(self, given):
+        z = self.model.run(dict(), names=self.outputs, given=given)
+        return np.hstack([z[x] for x in self.outputs])
+
+    def __call__(self, ins):
+        """Returns reference predictions (N, T) and effects (N, W, 4, T)
+        of substituting each position of the central window by each
+        nucleotide on the T outputs. Effects of reference nucleotides are
+        zero."""
+        model = self.model
+        layer = model.nodes[self.conv]
+        x = np.asarray(ins['s_x'], dtype='float32')
+        n, l = x.shape[:2]
+        k = layer.filter_len
+
+        static = model.run(ins, names=self.static)
+        # Pre-activations of reference sequences
+        r = layer.conv(layer.pad(x)) + layer.b
+        given = dict(static)
+        given[self.conv] = layer.activation(r)
+        z_ref = self._predict(given)
+
+        w0, w1 = self.window(l)
+        effects = np.zeros((n, w1 - w0, x.shape[2], z_ref.shape[1]),
+                           dtype='float32')
+        site, pos, base = np.nonzero(x[:, w0:w1] == 0)
+        pos += w0
+        has_ref = x[site, pos].sum(axis=1) > 0
+        ref = x[site, pos].argmax(axis=1)
+
+        W = layer.W[0]
+        taps = np.arange(k)
+        pl = k - 1 - (k - 1) // 2 if layer.border_mode == 'same' else 0
+        for i in range(0, len(site), self.batch_size):
+            j = slice(i, i + self.batch_size)
+            vsite = site[j]
+            h = r[vsite]
+            # Column c sees position p through filter tap p + pl - c
+            cols = pos[j, np.newaxis] + pl - taps
+            delta = W[taps, base[j, np.newaxis]]
+            delta -= W[taps, ref[j, np.newaxis]] * has_ref[j, np.newaxis,
+                                                           np.newaxis]
+            t = (cols >= 0) & (cols < h.shape[1])
+            v = np.repeat(np.arange(len(vsite))[:, np.newaxis], k, axis=1)
+            h[v[t], cols[t]] += delta[t]
+
+            given = {name: value[vsite] for name, value in static.items()}
+            given[self.conv] = layer.activation(h)
+            z = self._predict(given)
+            effects[vsite, pos[j] - w0, base[j]] = z - z_ref[vsite]
+        return (z_ref, effects)
@@ -267,17 +267,8 @@ def model_to_json(model, json_file, weights_file=None):
         model.save_weights(weights_file, overwrite=True)
 
 
-def progress(batch_index, nb_batch, s=20):
-    s = max(1, int(np.ceil(nb_batch / s)))
-    f = None
-    batch_index += 1
-    if batch_index == 1 or batch_index == nb_batch or batch_index % s == 0:
-        f = '%5d / %d (%.1f%%)' % (batch_index, nb_batch,
-                                   batch_index / nb_batch * 100)
-    return f
-
-
-def predict_loop(model, data, batch_size=128, callbacks=[], log=print, f=None):
+def predict_loop(model, data, batch_size=128, callbacks=[], log=print, f=None,
+                 batch_callbacks=[]):
     if f is None:
         f = model._predict
     ins = [data[name] for name in model.input_order]
@@ -288,7 +279,7 @@ def predict_loop(model, data, batch_size=128, callbacks=[], log=print, f=None):
     nb_batch = len(batches)
     for batch_index, (batch_start, batch_end) in enumerate(batches):
         if log is not None:
-            s = progress(batch_index, nb_batch)
+            s = ut.progress(batch_index, nb_batch)
             if s is not None:
                 log(s)
         for callback in callbacks:
@@ -307,10 +298,34 @@ def predict_loop(model, data, batch_size=128, callbacks=[], log=print, f=None):
 
         for i, batch_out in enumerate(batch_outs):
             outs[i][batch_start:batch_end] = batch_out
+        z = dict(zip(model.output_order, batch_outs))
+        for callback in batch_callbacks:
+            callback(batch_start, batch_end, z)
 
     return dict(zip(model.output_order, outs))
 
 
+def node_function(model, nodes):
+    """Compiles function returning outputs of `nodes` in test mode.
+
+    Returns function and names of inputs it must be called with.
+    """
+    import theano
+    if not isinstance(nodes, list):
+        nodes = [nodes]
+    outs = []
+    for node in nodes:
+        if node not in model.nodes:
+            raise ValueError('Node %s does not exist!' % (node))
+        outs.append(model.nodes[node].get_output(train=False))
+    used = theano.gof.graph.inputs(outs)
+    names = [name for name in model.input_order
+             if model.inputs[name].input in used]
+    ins = [model.inputs[name].input for name in names]
+    fun = theano.function(ins, outs, allow_input_downcast=True)
+    return (fun, names)
+
+
 def write_loop(ins, fun, write_fun, batch_size=128, callbacks=[], log=print):
     nb_sample = len(ins[0])
     batches = km.make_batches(nb_sample, batch_size)
@@ -318,7 +333,7 @@ def write_loop(ins, fun, write_fun, batch_size=128, callbacks=[], log=print):
     nb_batch = len(batches)
     for batch_index, (batch_start, batch_end) in enumerate(batches):
         if log is not None:
-            s = progress(batch_index, nb_batch)
+            s = ut.progress(batch_index, nb_batch)
             if s is not None:
                 log(s)
         for callback in callbacks:
@@ -0,0 +1,635 @@
+import json
+from collections import OrderedDict
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+import deepcpg.io as io
+import deepcpg.utils as ut
+
+
+def linear(x):
+    return x
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+activations = {'linear': linear,
+               'relu': relu,
+               'sigmoid': sigmoid,
+               'tanh': np.tanh}
+
+
+def get_activation(name):
+    if name not in activations:
+        raise ValueError('Activation %s not supported!' % (name))
+    return activations[name]
+
+
+def same_pad(filter_len):
+    """Left and right padding of Theano's border_mode='same'."""
+    right = (filter_len - 1) // 2
+    return (filter_len - 1 - right, right)
+
+
+def conv(x, W):
+    """Valid correlation of x (N, H, W, C) with W (kh, kw, C, F)."""
+    kh, kw, c, f = W.shape
+    n, h, w = x.shape[:3]
+    oh = h - kh + 1
+    ow = w - kw + 1
+    s = x.strides
+    cols = as_strided(x, (n, oh, ow, kh, kw, c),
+                      (s[0], s[1], s[2], s[1], s[2], s[3]))
+    y = np.dot(cols.reshape(-1, kh * kw * c), W.reshape(-1, f))
+    return y.reshape(n, oh, ow, f)
+
+
+class Layer(object):
+
+    nb_weight = 0
+
+    def set_weights(self, weights):
+        pass
+
+    def __call__(self, x):
+        raise NotImplementedError
+
+
+class Dropout(Layer):
+    """Identity unless `active`, e.g. for Monte-Carlo dropout."""
+
+    def __init__(self, p):
+        self.p = p
+        self.active = False
+
+    def __call__(self, x):
+        if not self.active or self.p <= 0:
+            return x
+        keep = np.random.random_sample(x.shape) >= self.p
+        return x * keep.astype(x.dtype) / np.float32(1 - self.p)
+
+
+class Flatten(Layer):
+
+    def __call__(self, x):
+        return x.reshape(x.shape[0], -1)
+
+
+class Activation(Layer):
+
+    def __init__(self, activation):
+        self.activation = get_activation(activation)
+
+    def __call__(self, x):
+        return self.activation(x)
+
+
+class Dense(Layer):
+
+    nb_weight = 2
+
+    def __init__(self, activation='linear'):
+        self.activation = get_activation(activation)
+
+    def set_weights(self, weights):
+        self.W = np.asarray(weights[0], dtype='float32')
+        self.b = np.asarray(weights[1], dtype='float32')
+
+    def __call__(self, x):
+        return self.activation(np.dot(x, self.W) + self.b)
+
+
+class BatchNormalization(Layer):
+
+    nb_weight = 4
+
+    def __init__(self, epsilon=1e-6):
+        self.epsilon = epsilon
+
+    def set_weights(self, weights):
+        gamma, beta, mean, std = [np.asarray(w, dtype='float32')
+                                  for w in weights]
+        # Fold running statistics into a single affine transformation
+        self.scale = gamma / (std + self.epsilon)
+        self.shift = beta - mean * self.scale
+
+    def __call__(self, x):
+        return x * self.scale + self.shift
+
+
+class Convolution1D(Layer):
+
+    nb_weight = 2
+
+    def __init__(self, activation='linear', border_mode='same'):
+        self.activation = get_activation(activation)
+        self.border_mode = border_mode
+
+    def set_weights(self, weights):
+        # Theano convolves, i.e. flips filters (nb_filter, input_dim, len, 1)
+        W = weights[0][:, :, ::-1, 0]
+        self.W = np.ascontiguousarray(W.transpose(2, 1, 0)[np.newaxis],
+                                      dtype='float32')
+        self.b = np.asarray(weights[1], dtype='float32')
+
+    @property
+    def filter_len(self):
+        return self.W.shape[1]
+
+    def pad(self, x):
+        if self.border_mode == 'same':
+            x = np.pad(x, ((0, 0), same_pad(self.filter_len), (0, 0)),
+                       'constant')
+        return x
+
+    def conv(self, x):
+        """Linear filter response of padded input x (N, L, C)."""
+        return conv(x[:, np.newaxis], self.W)[:, 0]
+
+    def __call__(self, x):
+        return self.activation(self.conv(self.pad(x)) + self.b)
+
+
+def sliding_conv1d(layer, x, chromo, pos):
+    """Outputs of Convolution1D `layer` for sequence windows x (N, L, C)
+    centered at `chromo`, `pos`.
+
+    Windows that overlap on the same chromosome are stitched into one
+    sequence, which is convolved only once. Only columns at window borders,
+    where the filter overlaps the zero padding, are computed per window.
+    """
+    n, l = x.shape[:2]
+    k = layer.filter_len
+    if layer.border_mode != 'same' or l < k:
+        return layer(x)
+    pl, pr = same_pad(k)
+    y = np.empty((n, l, layer.W.shape[-1]), dtype='float32')
+    if pl:
+        t = np.pad(x[:, :k - 1], ((0, 0), (pl, 0), (0, 0)), 'constant')
+        y[:, :pl] = layer.conv(t)
+    if pr:
+        t = np.pad(x[:, l - k + 1:], ((0, 0), (0, pr), (0, 0)), 'constant')
+        y[:, l - pr:] = layer.conv(t)
+
+    order = np.lexsort((pos, chromo))
+    p = np.asarray(pos)[order].astype('int64')
+    c = np.asarray(chromo)[order]
+    new_run = np.ones(n, dtype='bool')
+    new_run[1:] = (c[1:] != c[:-1]) | (np.diff(p) > l)
+    run_starts = np.nonzero(new_run)[0]
+    run = np.cumsum(new_run) - 1
+    offset = p - p[run_starts][run]
+    run_len = np.maximum.reduceat(offset, run_starts) + l
+    # Runs are concatenated, since interior outputs never cross run ends
+    start = np.hstack(([0], np.cumsum(run_len)[:-1]))[run] + offset
+    seq = np.zeros((run_len.sum(), x.shape[2]), dtype='float32')
+    seq[start[:, np.newaxis] + np.arange(l)] = x[order]
+    t = layer.conv(seq[np.newaxis])[0]
+    y[order, pl:l - pr] = t[start[:, np.newaxis] + np.arange(l - k + 1)]
+    return layer.activation(y + layer.b)
+
+
+class Convolution2D(Layer):
+
+    nb_weight = 2
+
+    def __init__(self, activation='linear', border_mode='same'):
+        self.activation = get_activation(activation)
+        self.border_mode = border_mode
+
+    def set_weights(self, weights):
+        # (nb_filter, stack_size, nb_row, nb_col) -> (row, col, stack, filter)
+        W = weights[0][:, :, ::-1, ::-1]
+        self.W = np.ascontiguousarray(W.transpose(2, 3, 1, 0),
+                                      dtype='float32')
+        self.b = np.asarray(weights[1], dtype='float32')
+
+    def __call__(self, x):
+        x = x.transpose(0, 2, 3, 1)
+        if self.border_mode == 'same':
+            pad = ((0, 0), same_pad(self.W.shape[0]),
+                   same_pad(self.W.shape[1]), (0, 0))
+            x = np.pad(x, pad, 'constant')
+        x = conv(np.ascontiguousarray(x), self.W) + self.b
+        return self.activation(x.transpose(0, 3, 1, 2))
+
+
+class MaxPooling1D(Layer):
+
+    def __init__(self, pool_length=2):
+        self.pool_length = pool_length
+
+    def __call__(self, x):
+        p = self.pool_length
+        n = x.shape[1] // p
+        x = x[:, :n * p].reshape(x.shape[0], n, p, x.shape[2])
+        return x.max(axis=2)
+
+
+class MaxPooling2D(Layer):
+
+    def __init__(self, pool_size=(2, 2)):
+        self.pool_size = tuple(pool_size)
+
+    def __call__(self, x):
+        pr, pc = self.pool_size
+        nr = x.shape[2] // pr
+        nc = x.shape[3] // pc
+        x = x[:, :, :nr * pr, :nc * pc]
+        x = x.reshape(x.shape[0], x.shape[1], nr, pr, nc, pc)
+        return x.max(axis=(3, 5))
+
+
+def layer_from_config(config):
+    name = config['name']
+    if name == 'Dropout':
+        return Dropout(config['p'])
+    elif name == 'Flatten':
+        return Flatten()
+    elif name == 'Activation':
+        return Activation(config['activation'])
+    elif name == 'Dense':
+        return Dense(config.get('activation', 'linear'))
+    elif name == 'BatchNormalization':
+        if config.get('mode', 0) != 0:
+            raise ValueError('Batch normalization mode not supported!')
+        return BatchNormalization(config.get('epsilon', 1e-6))
+    elif name == 'Convolution1D':
+        if config.get('subsample_length', 1) != 1:
+            raise ValueError('Strided convolutions not supported!')
+        return Convolution1D(config.get('activation', 'linear'),
+                             config.get('border_mode', 'valid'))
+    elif name == 'Convolution2D':
+        if tuple(config.get('subsample', (1, 1))) != (1, 1):
+            raise ValueError('Strided convolutions not supported!')
+        return Convolution2D(config.get('activation', 'linear'),
+                             config.get('border_mode', 'valid'))
+    elif name == 'MaxPooling1D':
+        stride = config.get('stride')
+        if stride is not None and stride != config['pool_length']:
+            raise ValueError('Pooling stride must equal pool length!')
+        return MaxPooling1D(config['pool_length'])
+    elif name == 'MaxPooling2D':
+        strides = config.get('strides')
+        pool_size = tuple(config['pool_size'])
+        if strides is not None and tuple(strides) != pool_size:
+            raise ValueError('Pooling strides must equal pool size!')
+        return MaxPooling2D(pool_size)
+    raise ValueError('Layer %s not supported!' % (name))
+
+
+class Model(object):
+
+    def __init__(self):
+        self.input_order = []
+        self.input_shapes = dict()
+        self.output_order = []
+        self.nodes = OrderedDict()
+        self.node_inputs = dict()
+        self.concat_axis = dict()
+        self.outputs = dict()
+
+    def add_input(self, name, input_shape=None):
+        self.input_order.append(name)
+        self.input_shapes[name] = input_shape
+
+    def add_node(self, layer, name, input=None, inputs=[], concat_axis=-1):
+        if input is not None:
+            inputs = [input]
+        self.nodes[name] = layer
+        self.node_inputs[name] = list(inputs)
+        self.concat_axis[name] = concat_axis
+
+    def add_output(self, name, input):
+        self.outputs[name] = input
+        self.output_order.append(name)
+
+    def set_weights(self, weights):
+        i = 0
+        for layer in self.nodes.values():
+            layer.set_weights(weights[i:i + layer.nb_weight])
+            i += layer.nb_weight
+        if i != len(weights):
+            raise ValueError('%d weights expected but %d given!' %
+                             (i, len(weights)))
+
+    def load_weights(self, path):
+        self.set_weights(io.read_weights(path))
+
+    def _needed(self, names, given):
+        needed = set()
+        stack = list(names)
+        while len(stack):
+            name = stack.pop()
+            if name in needed or name in given or name in self.input_order:
+                continue
+            needed.add(name)
+            stack.extend(self.node_inputs[name])
+        return needed
+
+    def run(self, ins, names=None, given=None):
+        """Compute nodes `names` from input dict `ins`.
+
+        `given` maps node names to precomputed outputs, which are used instead
+        of evaluating the nodes and their ancestors.
+        """
+        if names is None:
+            names = [self.outputs[x] for x in self.output_order]
+        if given is None:
+            given = dict()
+        values = dict(given)
+        needed = self._needed(names, values)
+        for name in self.input_order:
+            if name in ins:
+                values[name] = np.asarray(ins[name], dtype='float32')
+        for name, layer in self.nodes.items():
+            if name not in needed:
+                continue
+            x = [values[k] for k in self.node_inputs[name]]
+            if len(x) > 1:
+                x = np.concatenate(x, axis=self.concat_axis[name])
+            else:
+                x = x[0]
+            values[name] = layer(x)
+        return {k: values[k] for k in names}
+
+    def seq_conv(self):
+        """Name of first sequence convolution if it only depends on s_x."""
+        for name, layer in self.nodes.items():
+            if isinstance(layer, Convolution1D):
+                break
+        else:
+            return None
+        prev = self.node_inputs[name]
+        while len(prev) == 1 and prev[0] in self.nodes and \
+                isinstance(self.nodes[prev[0]], Dropout):
+            prev = self.node_inputs[prev[0]]
+        if prev != ['s_x']:
+            return None
+        return name
+
+    def dependents(self, names):
+        """Nodes `names` and all nodes depending on them."""
+        if not isinstance(names, list):
+            names = [names]
+        dynamic = set(names)
+        for name in self.nodes.keys():
+            if any([x in dynamic for x in self.node_inputs[name]]):
+                dynamic.add(name)
+        return dynamic
+
+    def static_nodes(self, names):
+        """Nodes independent of `names` whose outputs feed nodes that
+        depend on them."""
+        dynamic = self.dependents(names)
+        static = set()
+        for name in dynamic:
+            if name in self.nodes:
+                static.update([x for x in self.node_inputs[name]
+                               if x not in dynamic])
+        return sorted(static)
+
+    def _predict(self, *ins, **kwargs):
+        values = self.run(dict(zip(self.input_order, ins)), **kwargs)
+        return [values[self.outputs[x]] for x in self.output_order]
+
+    def predict(self, data, batch_size=128, callbacks=[], log=None):
+        return predict_loop(self, data, batch_size=batch_size,
+                            callbacks=callbacks, log=log)
+
+
+def cpg_layers(params):
+    layers = []
+    if params.drop_in:
+        layers.append(('xd', Dropout(params.drop_in)))
+    for l in range(len(params.nb_filter)):
+        layer = Convolution2D(activation=params.activation,
+                              border_mode='same')
+        layers.append(('c%d' % (l + 1), layer))
+        layer = MaxPooling2D(pool_size=(1, params.pool_len[l]))
+        layers.append(('p%d' % (l + 1), layer))
+    layers.append(('f1', Flatten()))
+    if params.drop_out:
+        layers.append(('f1d', Dropout(params.drop_out)))
+    if params.nb_hidden:
+        layers.extend(hidden_layers(params))
+    return layers
+
+
+def seq_layers(params):
+    layers = []
+    if params.drop_in:
+        layers.append(('xd', Dropout(params.drop_in)))
+    for l in range(len(params.nb_filter)):
+        layer = Convolution1D(activation=params.activation,
+                              border_mode='same')
+        layers.append(('c%d' % (l + 1), layer))
+        layer = MaxPooling1D(pool_length=params.pool_len[l])
+        layers.append(('p%d' % (l + 1), layer))
+    layers.append(('f1', Flatten()))
+    if params.drop_out:
+        layers.append(('f1d', Dropout(params.drop_out)))
+    if params.nb_hidden:
+        layers.extend(hidden_layers(params))
+    return layers
+
+
+def hidden_layers(params):
+    layers = []
+    layers.append(('h1', Dense(activation='linear')))
+    if params.batch_norm:
+        layers.append(('h1b', BatchNormalization()))
+    layers.append(('h1a', Activation(params.activation)))
+    if params.drop_out:
+        layers.append(('h1d', Dropout(params.drop_out)))
+    return layers
+
+
+def target_layers(params):
+    layers = []
+    if params.nb_hidden:
+        layers.extend(hidden_layers(params))
+    layers.append(('o', Dense(activation='sigmoid')))
+    return layers
+
+
+def add_layers(model, layers, prev_nodes, prefix):
+    for cur_node, cur_layer in layers:
+        cur_node = '%s_%s' % (prefix, cur_node)
+        model.add_node(cur_layer, cur_node, inputs=prev_nodes)
+        prev_nodes = [cur_node]
+    return prev_nodes
+
+
+def build(params, targets):
+    """Mirrors net.build without compiling a Theano graph."""
+    model = Model()
+    branch_nodes = []
+    if params.seq:
+        model.add_input('s_x')
+        layers = seq_layers(params.seq)
+        branch_nodes.extend(add_layers(model, layers, ['s_x'], 's'))
+
+    if params.cpg:
+        model.add_input('c_x')
+        layers = cpg_layers(params.cpg)
+        branch_nodes.extend(add_layers(model, layers, ['c_x'], 'c'))
+
+    if params.joint and params.joint.nb_hidden > 0:
+        layers = hidden_layers(params.joint)
+        branch_nodes = add_layers(model, layers, branch_nodes, 'j')
+
+    for target in targets:
+        layers = target_layers(params.target)
+        last = add_layers(model, layers, branch_nodes, target)
+        model.add_output('%s_y' % (target), last[0])
+    return model
+
+
+def model_from_config(config):
+    model = Model()
+    for x in config['input_config']:
+        model.add_input(x['name'], x.get('input_shape'))
+    for x in config['node_config']:
+        if x.get('inputs') and x.get('merge_mode', 'concat') != 'concat':
+            raise ValueError('Merge mode %s not supported!' %
+                             (x['merge_mode']))
+        layer = layer_from_config(config['nodes'][x['name']])
+        model.add_node(layer, x['name'], input=x.get('input'),
+                       inputs=x.get('inputs') or [],
+                       concat_axis=x.get('concat_axis', -1))
+    outputs = {x['name']: x for x in config['output_config']}
+    for name in config['output_order']:
+        if not outputs[name].get('input'):
+            raise ValueError('Output %s must have a single input!' % (name))
+        model.add_output(name, outputs[name]['input'])
+    if 'input_order' in config:
+        model.input_order = list(config['input_order'])
+    return model
+
+
+def model_from_json(json_file, weights_file=None):
+    with open(json_file, 'r') as f:
+        config = json.loads(f.read())
+    model = model_from_config(config)
+    if weights_file is not None:
+        model.load_weights(weights_file)
+    return model
+
+
+def model_from_params(params, targets, weights_file=None):
+    model = build(params, targets)
+    if weights_file is not None:
+        model.load_weights(weights_file)
+    return model
+
+
+def model_from_list(fnames):
+    if len(fnames) != 2:
+        raise ValueError('JSON and weights file required!')
+    return model_from_json(fnames[0], fnames[1])
+
+
+def mc_predict(model, ins, nb_draw):
+    """Mean and variance of `nb_draw` predictions with active dropout.
+
+    Nodes that do not depend on dropout are evaluated once and their outputs
+    tiled, such that all draws are computed in one forward pass.
+    """
+    drop = [name for name, layer in model.nodes.items()
+            if isinstance(layer, Dropout) and layer.p > 0]
+    if len(drop) == 0:
+        raise ValueError('Model has no dropout layers!')
+    names = [model.outputs[x] for x in model.output_order]
+    dynamic = model.dependents(drop)
+    static = model.static_nodes(drop)
+    static += [x for x in names if x not in dynamic and x not in static]
+    given = model.run(ins, names=static)
+    for k, v in given.items():
+        given[k] = np.tile(v, (nb_draw,) + (1,) * (v.ndim - 1))
+    for name in drop:
+        model.nodes[name].active = True
+    try:
+        z = model.run(dict(), names=names, given=given)
+    finally:
+        for name in drop:
+            model.nodes[name].active = False
+    mean = []
+    var = []
+    for name in names:
+        x = z[name].reshape((nb_draw, -1) + z[name].shape[1:])
+        mean.append(x.mean(axis=0))
+        var.append(x.var(axis=0))
+    return (mean, var)
+
+
+def predict_loop(model, data, batch_size=128, callbacks=[], log=print,
+                 sliding=False, mc_dropout=None, batch_callbacks=[]):
+    """Predict outputs of `model` on `data` batch-wise.
+
+    `batch_callbacks` are called with the start, end, and predictions of
+    each batch, e.g. to evaluate predictions incrementally.
+
+    If `sliding`, the first sequence convolution is shared between
+    overlapping windows of a batch, which is most effective if data are
+    sorted by `chromo` and `pos`.
+
+    If `mc_dropout`, returns mean and variance of `mc_dropout` predictions
+    with active dropout instead of predictions.
+    """
+    ins = [data[name] for name in model.input_order]
+    nb_sample = len(ins[0])
+    if sliding and mc_dropout:
+        raise ValueError('Sliding convolution and MC dropout exclusive!')
+    if sliding:
+        conv = model.seq_conv()
+        if conv is None:
+            raise ValueError('Model has no sequence convolution!')
+    outs = []
+    batches = ut.make_batches(nb_sample, batch_size)
+    nb_batch = len(batches)
+    for batch_index, (batch_start, batch_end) in enumerate(batches):
+        if log is not None:
+            s = ut.progress(batch_index, nb_batch)
+            if s is not None:
+                log(s)
+        for callback in callbacks:
+            callback(batch_index, nb_batch)
+        ins_batch = [x[batch_start:batch_end] for x in ins]
+        given = None
+        if sliding:
+            x = ins_batch[model.input_order.index('s_x')]
+            given = {conv: sliding_conv1d(
+                model.nodes[conv], np.asarray(x, dtype='float32'),
+                data['chromo'][batch_start:batch_end],
+                data['pos'][batch_start:batch_end])}
+        if mc_dropout:
+            mean, var = mc_predict(model, dict(zip(model.input_order,
+                                                   ins_batch)), mc_dropout)
+            batch_outs = mean + var
+        else:
+            batch_outs = model._predict(*ins_batch, given=given)
+
+        if batch_index == 0:
+            for batch_out in batch_outs:
+                shape = (nb_sample,) + batch_out.shape[1:]
+                outs.append(np.zeros(shape, dtype=batch_out.dtype))
+
+        for i, batch_out in enumerate(batch_outs):
+            outs[i][batch_start:batch_end] = batch_out
+        z = dict(zip(model.output_order, batch_outs))
+        for callback in batch_callbacks:
+            callback(batch_start, batch_end, z)
+
+    if mc_dropout:
+        nb_out = len(model.output_order)
+        return (dict(zip(model.output_order, outs[:nb_out])),
+                dict(zip(model.output_order, outs[nb_out:])))
+    return dict(zip(model.output_order, outs))
@@ -0,0 +1,233 @@
+import multiprocessing as mp
+import numpy as np
+from keras import callbacks as kcbks
+
+import deepcpg.io as io
+import deepcpg.utils as ut
+
+
+def flatten(weights, out=None):
+    if out is None:
+        out = np.empty(sum([w.size for w in weights]), dtype='float32')
+    i = 0
+    for w in weights:
+        out[i:i + w.size] = w.ravel()
+        i += w.size
+    return out
+
+
+def unflatten(x, like):
+    weights = []
+    i = 0
+    for w in like:
+        weights.append(x[i:i + w.size].reshape(w.shape).astype(w.dtype))
+        i += w.size
+    return weights
+
+
+def hdf_loader(path, outputs, cache_size=None):
+    """Returns function that opens training data and sample weights."""
+    def load():
+        f, data = io.read_hdf(path, cache_size)
+        index = io.read_coverage(f, outputs)
+        weights = {k: io.WeightView(data[k], index=index) for k in outputs}
+        io.to_view(data, index=index)
+        return (data, weights)
+    return load
+
+
+def _loss(outs):
+    if isinstance(outs, list):
+        outs = outs[0]
+    return float(outs)
+
+
+def _work(model, rank, conn, shared, load, batch_size):
+    # Errors of loading are sent in reply to each round
+    error = None
+    try:
+        data, weights = load()
+        data = {k: data[k] for k in model.input_order + model.output_order}
+    except Exception as e:
+        error = e
+    like = model.get_weights()
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        if error is not None:
+            conn.send(error)
+            continue
+        try:
+            if msg == 'state':
+                conn.send(model.optimizer.get_state())
+                continue
+            lr, (start, end) = msg
+            model.set_weights(unflatten(shared[0], like))
+            model.optimizer.lr.set_value(lr)
+            block = {k: v[start:end] for k, v in data.items()}
+            block_weights = {k: v[start:end] for k, v in weights.items()}
+            t = np.random.permutation(end - start)
+            logs = []
+            for i, j in ut.make_batches(end - start, batch_size):
+                ids = t[i:j]
+                outs = model.train_on_batch(
+                    {k: v[ids] for k, v in block.items()},
+                    sample_weight={k: v[ids]
+                                   for k, v in block_weights.items()})
+                logs.append({'size': j - i, 'loss': _loss(outs)})
+            flatten(model.get_weights(), shared[rank + 1])
+            conn.send(logs)
+        except Exception as e:
+            conn.send(e)
+
+
+class ParallelTrainer(object):
+    """Data-parallel training with forked worker processes.
+
+    Each round, every worker trains a copy of `model` on `sync_every`
+    batches of a different block of rows, which are drawn in random order
+    from the whole file. Weights are then averaged over workers through
+    shared memory. Workers keep their own optimizer state, of which the
+    state of the first worker is copied to `model` after each epoch, e.g.
+    for checkpoints. Callbacks and validation run on the coordinator with
+    the averaged weights.
+
+    `load` is called in each worker and must return dicts of training data
+    and sample weights, e.g. from `hdf_loader`.
+    """
+
+    def __init__(self, model, load, nb_worker=2, batch_size=128,
+                 sync_every=16):
+        self.model = model
+        self.load = load
+        self.nb_worker = nb_worker
+        self.batch_size = batch_size
+        self.sync_every = sync_every
+        self._workers = []
+
+    def start(self):
+        model = self.model
+        size = flatten(model.get_weights()).size
+        raw = mp.RawArray('f', (self.nb_worker + 1) * size)
+        self.shared = np.frombuffer(raw, dtype='float32').reshape(
+            self.nb_worker + 1, size)
+        ctx = mp.get_context('fork')
+        for rank in range(self.nb_worker):
+            conn, child = ctx.Pipe()
+            # Seed workers differently for shuffling rows
+            seed = np.random.randint(2**31)
+            p = ctx.Process(target=self._run,
+                            args=(rank, child, seed))
+            p.daemon = True
+            p.start()
+            # recv raises EOFError instead of blocking if the worker dies
+            child.close()
+            self._workers.append((p, conn))
+
+    def _run(self, rank, conn, seed):
+        np.random.seed(seed)
+        _work(self.model, rank, conn, self.shared, self.load,
+              self.batch_size)
+
+    def stop(self):
+        for p, conn in self._workers:
+            if p.is_alive():
+                try:
+                    conn.send(None)
+                except (IOError, OSError):
+                    pass
+        for p, conn in self._workers:
+            p.join()
+            conn.close()
+        self._workers = []
+
+    def blocks(self, nb_row, nb_sample):
+        """Row blocks of one epoch in random order."""
+        size = self.batch_size * self.sync_every
+        blocks = ut.make_batches(nb_row, size)
+        blocks = [blocks[i] for i in np.random.permutation(len(blocks))]
+        n = 0
+        for i, (start, end) in enumerate(blocks):
+            n += end - start
+            if n >= nb_sample:
+                return blocks[:i + 1]
+        return blocks
+
+    def round(self, blocks):
+        """Trains workers on `blocks` and averages their weights."""
+        model = self.model
+        flatten(model.get_weights(), self.shared[0])
+        lr = model.optimizer.lr.get_value()
+        workers = self._workers[:len(blocks)]
+        for (p, conn), block in zip(workers, blocks):
+            conn.send((lr, block))
+        logs = []
+        for p, conn in workers:
+            msg = conn.recv()
+            if isinstance(msg, Exception):
+                raise msg
+            logs.extend(msg)
+        w = self.shared[1:len(workers) + 1].mean(axis=0)
+        model.set_weights(unflatten(w, model.get_weights()))
+        return logs
+
+    def optimizer_state(self):
+        """Returns optimizer state of the first worker."""
+        p, conn = self._workers[0]
+        conn.send('state')
+        msg = conn.recv()
+        if isinstance(msg, Exception):
+            raise msg
+        return msg
+
+    def fit(self, nb_row, nb_sample=None, nb_epoch=1, callbacks=[],
+            val_data=None, val_sample_weight=None):
+        """Trains on `nb_sample` of `nb_row` rows per epoch."""
+        model = self.model
+        if nb_sample is None:
+            nb_sample = nb_row
+        nb_sample = min(nb_row, nb_sample)
+        callbacks = kcbks.CallbackList(callbacks)
+        callbacks._set_model(model)
+        callbacks._set_params({
+            'batch_size': self.batch_size,
+            'nb_epoch': nb_epoch,
+            'nb_sample': nb_sample,
+            'verbose': 0,
+            'do_validation': val_data is not None
+        })
+        if len(self._workers) == 0:
+            self.start()
+        model.stop_training = False
+        try:
+            self._fit(nb_row, nb_sample, nb_epoch, callbacks, val_data,
+                      val_sample_weight)
+        finally:
+            self.stop()
+
+    def _fit(self, nb_row, nb_sample, nb_epoch, callbacks, val_data,
+             val_sample_weight):
+        model = self.model
+        callbacks.on_train_begin()
+        for epoch in range(nb_epoch):
+            callbacks.on_epoch_begin(epoch)
+            blocks = self.blocks(nb_row, nb_sample)
+            batch = 0
+            for i in range(0, len(blocks), self.nb_worker):
+                for logs in self.round(blocks[i:i + self.nb_worker]):
+                    logs['batch'] = batch
+                    callbacks.on_batch_begin(batch, logs)
+                    callbacks.on_batch_end(batch, logs)
+                    batch += 1
+            epoch_logs = dict()
+            if val_data is not None:
+                outs = model.evaluate(val_data, batch_size=self.batch_size,
+                                      sample_weight=val_sample_weight,
+                                      verbose=0)
+                epoch_logs['val_loss'] = _loss(outs)
+            model.optimizer.set_state(self.optimizer_state())
+            callbacks.on_epoch_end(epoch, epoch_logs)
+            if model.stop_training:
+                break
+        callbacks.on_train_end()
@@ -0,0 +1,180 @@
+import json
+import queue
+import threading
+from collections import deque
+from io import BytesIO
+from time import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+
+def to_npz(data):
+    buf = BytesIO()
+    np.savez(buf, **data)
+    return buf.getvalue()
+
+
+def from_npz(s):
+    d = np.load(BytesIO(s))
+    return {k: d[k] for k in d.files}
+
+
+class Batcher(object):
+    """Coalesces concurrent prediction requests into batches.
+
+    Requests are collected until `max_batch` samples are queued or the first
+    request waited `max_latency` seconds. `predict` is called on the
+    concatenated inputs from a single worker thread. `shapes` maps inputs
+    to the shapes of single samples, which requests must match.
+    """
+
+    def __init__(self, predict, inputs, shapes=None, max_batch=1024,
+                 max_latency=0.01, nb_stat=1000):
+        self.predict = predict
+        self.inputs = inputs
+        self.shapes = shapes or dict()
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self._latencies = deque(maxlen=nb_stat)
+        self._batch_sizes = deque(maxlen=nb_stat)
+        self._nb_request = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, data):
+        # Reject invalid requests before they can fail a whole batch
+        for k in self.inputs:
+            if k not in data:
+                raise KeyError('Input %s missing!' % (k))
+            shape = self.shapes.get(k)
+            if shape is not None and \
+                    tuple(np.shape(data[k])[1:]) != tuple(shape):
+                raise ValueError('Shape %s of input %s differs from %s!' %
+                                 (str(np.shape(data[k])[1:]), k,
+                                  str(tuple(shape))))
+        if len(set([len(data[k]) for k in self.inputs])) > 1:
+            raise ValueError('Inputs differ in length!')
+        req = {'data': data,
+               'size': len(data[self.inputs[0]]),
+               'time': time(),
+               'done': threading.Event()}
+        self.queue.put(req)
+        req['done'].wait()
+        if 'error' in req:
+            raise req['error']
+        return req['z']
+
+    def _next(self):
+        reqs = [self.queue.get()]
+        size = reqs[0]['size']
+        deadline = reqs[0]['time'] + self.max_latency
+        while size < self.max_batch:
+            timeout = deadline - time()
+            try:
+                if timeout > 0:
+                    req = self.queue.get(timeout=timeout)
+                else:
+                    req = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            reqs.append(req)
+            size += req['size']
+        return reqs
+
+    def _run(self):
+        while True:
+            reqs = self._next()
+            try:
+                data = dict()
+                for k in self.inputs:
+                    data[k] = np.concatenate([r['data'][k] for r in reqs])
+                z = self.predict(data)
+                i = 0
+                for req in reqs:
+                    j = i + req['size']
+                    req['z'] = {k: v[i:j] for k, v in z.items()}
+                    i = j
+            except Exception as e:
+                for req in reqs:
+                    req['error'] = e
+            t = time()
+            for req in reqs:
+                self._latencies.append(t - req['time'])
+                req['done'].set()
+            self._batch_sizes.append(sum([r['size'] for r in reqs]))
+            self._nb_request += len(reqs)
+
+    def stats(self):
+        s = dict()
+        s['queue_depth'] = self.queue.qsize()
+        s['nb_request'] = self._nb_request
+        latencies = np.array(self._latencies) * 1000
+        batch_sizes = np.array(self._batch_sizes)
+        if len(latencies):
+            for p in [50, 90, 99]:
+                s['latency_p%d' % (p)] = float(np.percentile(latencies, p))
+        if len(batch_sizes):
+            s['batch_size'] = float(batch_sizes.mean())
+        return s
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        n = int(self.headers['Content-Length'])
+        try:
+            z = self.server.batcher(from_npz(self.rfile.read(n)))
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self._send(to_npz(z), 'application/octet-stream')
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        s = json.dumps(self.server.batcher.stats())
+        self._send(s.encode(), 'application/json')
+
+    def log_message(self, *args):
+        if self.server.log is not None:
+            self.server.log(args[0] % args[1:])
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, batcher, host='localhost', port=8000, log=None):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.batcher = batcher
+        self.log = log
+
+
+def predict(url, data, timeout=None):
+    """Request predictions for input dict `data` from server at `url`."""
+    req = Request(url.rstrip('/') + '/predict', data=to_npz(data),
+                  headers={'Content-Type': 'application/octet-stream'})
+    with urlopen(req, timeout=timeout) as f:
+        return from_npz(f.read())
+
+
+def stats(url, timeout=None):
+    with urlopen(url.rstrip('/') + '/stats', timeout=timeout) as f:
+        return json.loads(f.read().decode())
@@ -1,3 +1,8 @@
+import os
+import re
+import numpy as np
+
+
 def ranges_to_list(x, start=0, stop=None):
     s = set()
     for xi in x:
@@ -35,3 +40,34 @@ def dict_to_str(d):
     for k in sorted(d.keys()):
         s.append('%s: %s' % (k, str(d[k])))
     return '\n'.join(s)
+
+
+def progress(batch_index, nb_batch, s=20):
+    s = max(1, int(np.ceil(nb_batch / s)))
+    f = None
+    batch_index += 1
+    if batch_index == 1 or batch_index == nb_batch or batch_index % s == 0:
+        f = '%5d / %d (%.1f%%)' % (batch_index, nb_batch,
+                                   batch_index / nb_batch * 100)
+    return f
+
+
+def make_batches(size, batch_size):
+    nb_batch = int(np.ceil(size / float(batch_size)))
+    return [(i * batch_size, min(size, (i + 1) * batch_size))
+            for i in range(nb_batch)]
+
+
+def rss():
+    """Current resident memory of the process in MB, or NaN if unknown."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        return np.nan
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import logging
+import os.path as pt
+import numpy as np
+import h5py as h5
+
+import deepcpg.io as io
+import deepcpg.net as net
+
+
+def reduce_act(x, fun):
+    """Reduces activations over positions."""
+    if fun == 'none' or x.ndim < 3:
+        return x
+    if x.ndim == 3:
+        # Convolution1D: samples x positions x filters
+        axis = 1
+    else:
+        # Convolution2D: samples x filters x cells x positions
+        axis = -1
+    return getattr(np, fun)(x, axis=axis)
+
+
+class App(object):
+
+    def run(self, args):
+        name = pt.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        self.opts = opts
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Writes activations of model nodes')
+        p.add_argument(
+            'data_file',
+            help='Data file')
+        p.add_argument(
+            '--model',
+            help='Model files',
+            nargs='+')
+        p.add_argument(
+            '--nodes',
+            help='Names of nodes, e.g. s_c1 c_c1 j_h1a',
+            nargs='+',
+            default=['s_c1'])
+        p.add_argument(
+            '--reduce',
+            help='Reduce activations over positions',
+            choices=['none', 'max', 'mean'],
+            default='none')
+        p.add_argument(
+            '-o', '--out_file',
+            help='Output file',
+            default='activations.h5')
+        p.add_argument(
+            '--out_dtype',
+            help='Data type of activations',
+            choices=['float32', 'float16'],
+            default='float32')
+        p.add_argument(
+            '--compression',
+            help='HDF compression filter',
+            choices=['gzip', 'lzf', 'none'],
+            default='gzip')
+        p.add_argument(
+            '--chromo',
+            help='Chromosome')
+        p.add_argument(
+            '--start',
+            help='Start position',
+            type=int)
+        p.add_argument(
+            '--end',
+            help='End position',
+            type=int)
+        p.add_argument(
+            '--nb_sample',
+            help='Maximum # samples',
+            type=int)
+        p.add_argument(
+            '--batch_size',
+            help='Batch size',
+            type=int,
+            default=128)
+        p.add_argument(
+            '--max_mem',
+            help='Maximum memory load',
+            type=int,
+            default=14000)
+        p.add_argument(
+            '--seed',
+            help='Seed of rng',
+            type=int,
+            default=0)
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def main(self, name, opts):
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+            log.debug(opts)
+
+        if opts.seed is not None:
+            np.random.seed(opts.seed)
+
+        log.info('Load model')
+        model = net.model_from_list(opts.model, compile=False)
+        log.info('Compile function')
+        fun, inputs = net.node_function(model, opts.nodes)
+
+        log.info('Load data')
+        data_file, data = io.read_hdf(opts.data_file, opts.max_mem)
+        data = {k: data[k] for k in inputs + ['chromo', 'pos']}
+        if opts.chromo is not None:
+            io.select_cpos(data, opts.chromo, opts.start, opts.end)
+        io.to_view(data, stop=opts.nb_sample)
+        nb_sample = len(data['pos'])
+        print('%d samples' % (nb_sample))
+
+        out_file = h5.File(opts.out_file, 'w')
+        out_file['chromo'] = data['chromo'][:]
+        out_file['pos'] = data['pos'][:]
+        out_file.attrs['reduce'] = opts.reduce
+        group = out_file.create_group('act')
+        compression = opts.compression
+        if compression == 'none':
+            compression = None
+
+        def write_fun(outs, start, end):
+            for node, out in zip(opts.nodes, outs):
+                out = reduce_act(out, opts.reduce)
+                if node not in group:
+                    shape = (nb_sample,) + out.shape[1:]
+                    chunks = (min(nb_sample, opts.batch_size),) + \
+                        out.shape[1:]
+                    group.create_dataset(node, shape, dtype=opts.out_dtype,
+                                         chunks=chunks,
+                                         compression=compression)
+                group[node][start:end] = out
+
+        log.info('Write activations')
+        net.write_loop([data[k] for k in inputs], fun, write_fun,
+                       batch_size=opts.batch_size, log=log.info)
+
+        out_file.close()
+        data_file.close()
+        log.info('Done!')
+
+        return 0
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
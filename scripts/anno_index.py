@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import logging
+import os.path as pt
+import numpy as np
+import h5py as h5
+
+import deepcpg.data as dat
+import deepcpg.utils as ut
+
+
+def read_pos(path):
+    """Returns sorted positions per chromosome of data or prediction file."""
+    f = h5.File(path, 'r')
+    pos = dict()
+    if 'pos' in f:
+        # Data file
+        chromos = f['pos/chromo'][:]
+        p = f['pos/pos'][:]
+        for chromo in np.unique(chromos):
+            pos[chromo.decode()] = p[chromos == chromo]
+    elif 'targets' in f.attrs:
+        # Prediction matrix file
+        for chromo in f.keys():
+            pos[chromo] = f[chromo]['pos'][:]
+    else:
+        # Prediction file with one group per target
+        for target in f.keys():
+            for chromo in f[target].keys():
+                p = f[target][chromo]['pos'][:]
+                if chromo in pos:
+                    p = np.hstack((pos[chromo], p))
+                pos[chromo] = p
+    f.close()
+    for chromo in pos.keys():
+        pos[chromo] = np.unique(pos[chromo])
+    return pos
+
+
+class App(object):
+
+    def run(self, args):
+        name = pt.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        self.opts = opts
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Builds annotation index of sites of data or ' +
+            'prediction file')
+        p.add_argument(
+            'in_file',
+            help='Data or prediction file')
+        p.add_argument(
+            '--annos_file',
+            help='HDF file with annotations',
+            required=True)
+        p.add_argument(
+            '--annos',
+            help='Regex of annotations to be indexed',
+            nargs='+')
+        p.add_argument(
+            '--chromos',
+            help='Only index chromosomes',
+            nargs='+')
+        p.add_argument(
+            '-o', '--out_file',
+            help='Output file',
+            default='annos.h5')
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def main(self, name, opts):
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+            log.debug(opts)
+
+        log.info('Read positions')
+        pos = read_pos(opts.in_file)
+        chromos = sorted(pos.keys())
+        if opts.chromos is not None:
+            chromos = [x for x in chromos if x in opts.chromos]
+        if len(chromos) == 0:
+            raise ValueError('No chromosomes match selection!')
+
+        # Annotations of any selected chromosome
+        f = h5.File(opts.annos_file, 'r')
+        names = set()
+        for chromo in chromos:
+            if chromo in f:
+                names.update(f[chromo].keys())
+        names = sorted(names)
+        f.close()
+        if opts.annos is not None:
+            names = ut.filter_regex(names, opts.annos)
+        if len(names) == 0:
+            raise ValueError('No annotations match selection!')
+        log.info('%d annotations' % (len(names)))
+
+        out_file = h5.File(opts.out_file, 'w')
+        out_file.attrs['annos'] = np.array([x.encode() for x in names])
+        for chromo in chromos:
+            log.info('Chromosome %s' % (chromo))
+            bits = dat.anno_bits(opts.annos_file, chromo, names, pos[chromo])
+            g = out_file.create_group(chromo)
+            g['pos'] = pos[chromo].astype('int32')
+            g.create_dataset('bits', data=np.packbits(bits, axis=1),
+                             compression='gzip')
+            print('%s: %d sites, %d annotated' %
+                  (chromo, len(bits), bits.any(axis=1).sum()))
+        out_file.close()
+        log.info('Done!')
+
+        return 0
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
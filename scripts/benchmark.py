@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import logging
+import os.path as pt
+import numpy as np
+import pandas as pd
+from time import time
+
+import deepcpg.io as io
+import deepcpg.evaluation as ev
+import deepcpg.utils as ut
+import deepcpg.npnet as npnet
+
+
+def throughput(fun, nb_sample, nb_repeat=1):
+    times = []
+    for i in range(nb_repeat):
+        t = time()
+        out = fun()
+        times.append(time() - t)
+    return (out, nb_sample / min(times))
+
+
+class App(object):
+
+    def run(self, args):
+        name = pt.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        self.opts = opts
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Benchmark throughput of DeepCpG components')
+        p.add_argument(
+            'bench',
+            help='Component to be benchmarked',
+            choices=['infer', 'sampler', 'train', 'eval'])
+        p.add_argument(
+            'data_file',
+            help='Data file')
+        p.add_argument(
+            '--model',
+            help='Model files',
+            nargs='+')
+        p.add_argument(
+            '--batch_size',
+            help='Batch size',
+            type=int,
+            default=128)
+        p.add_argument(
+            '--nb_sample',
+            help='Maximum # samples',
+            type=int,
+            default=10000)
+        p.add_argument(
+            '--nb_repeat',
+            help='Repeat measurements and report best',
+            type=int,
+            default=3)
+        p.add_argument(
+            '--shuffle_buffer',
+            help='# chunks that are shuffled together by chunk sampler',
+            type=int,
+            default=8)
+        p.add_argument(
+            '--nb_worker',
+            help='# processes for data-parallel training or evaluation',
+            type=int,
+            nargs='+',
+            default=[1])
+        p.add_argument(
+            '--sync_every',
+            help='# batches after which weights of workers are averaged',
+            type=int,
+            default=16)
+        p.add_argument(
+            '--compare',
+            help='Compare NumPy forward pass with Keras model',
+            action='store_true')
+        p.add_argument(
+            '--sliding',
+            help='Also measure NumPy forward pass with sliding convolution',
+            action='store_true')
+        p.add_argument(
+            '--atol',
+            help='Maximum absolute difference to Keras predictions',
+            type=float,
+            default=1e-4)
+        p.add_argument(
+            '--seed',
+            help='Seed of rng',
+            type=int,
+            default=0)
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def bench_infer(self, data):
+        opts = self.opts
+        nb_sample = len(list(data.values())[0])
+        # Load data into memory to measure compute and not I/O
+        data = {k: v[:] for k, v in data.items()}
+
+        self.log.info('NumPy forward pass')
+        model = npnet.model_from_list(opts.model)
+        z, speed = throughput(
+            lambda: npnet.predict_loop(model, data, opts.batch_size, log=None),
+            nb_sample, opts.nb_repeat)
+        print('numpy: %.1f samples/s' % (speed))
+
+        if opts.sliding:
+            self.log.info('NumPy forward pass with sliding convolution')
+            zs, speed = throughput(
+                lambda: npnet.predict_loop(model, data, opts.batch_size,
+                                           log=None, sliding=True),
+                nb_sample, opts.nb_repeat)
+            print('numpy sliding: %.1f samples/s' % (speed))
+            for k in model.output_order:
+                print('%s: max abs diff=%g' % (k, np.abs(z[k] - zs[k]).max()))
+
+        if opts.compare:
+            self.log.info('Keras forward pass')
+            import deepcpg.net as net
+            kmodel = net.model_from_list(opts.model)
+            zk, speed = throughput(
+                lambda: net.predict_loop(kmodel, data, opts.batch_size,
+                                         log=None),
+                nb_sample, opts.nb_repeat)
+            print('keras: %.1f samples/s' % (speed))
+            ok = True
+            for k in model.output_order:
+                d = np.abs(z[k] - zk[k]).max()
+                print('%s: max abs diff=%g' % (k, d))
+                ok &= d <= opts.atol
+            if not ok:
+                self.log.error('Predictions differ by more than %g!' %
+                               (opts.atol))
+                return 1
+        return 0
+
+    def bench_sampler(self, data):
+        opts = self.opts
+        data = {k: v.data for k, v in data.items()}
+        nb_sample = min(opts.nb_sample, list(data.values())[0].shape[0])
+
+        def read_epoch(views, shuffle):
+            batches = ut.make_batches(nb_sample, opts.batch_size)
+            if shuffle:
+                np.random.shuffle(batches)
+            for start, end in batches:
+                ids = list(range(start, end))
+                for v in views.values():
+                    v[ids]
+
+        self.log.info('DataJumper window with batch shuffling')
+
+        def jump():
+            n = list(data.values())[0].shape[0]
+            i = np.random.randint(n - nb_sample + 1)
+            views = {k: io.ArrayView(v, i, i + nb_sample)
+                     for k, v in data.items()}
+            read_epoch(views, True)
+
+        _, speed = throughput(jump, nb_sample, opts.nb_repeat)
+        print('jump: %.1f samples/s' % (speed))
+
+        self.log.info('Chunk sampler')
+        sampler = io.ChunkSampler(data, nb_sample=nb_sample,
+                                  nb_buffer=opts.shuffle_buffer)
+        views = {k: io.ArrayView(sampler.view(k)) for k in data.keys()}
+
+        def chunk():
+            sampler.shuffle()
+            read_epoch(views, False)
+
+        _, speed = throughput(chunk, nb_sample, opts.nb_repeat)
+        print('chunk: %.1f samples/s (%d chunks of %d rows)' %
+              (speed, len(sampler._chunks), sampler.chunk_size))
+        return 0
+
+    def bench_train(self, data):
+        opts = self.opts
+        import deepcpg.net as net
+        import deepcpg.parallel as par
+        model = net.model_from_list(opts.model)
+        weights = model.get_weights()
+        nb_row = list(data.values())[0].data.shape[0]
+        nb_sample = min(opts.nb_sample, nb_row)
+        loader = par.hdf_loader(opts.data_file, model.output_order)
+        for nb_worker in opts.nb_worker:
+            self.log.info('Train with %d workers' % (nb_worker))
+            trainer = par.ParallelTrainer(model, loader, nb_worker=nb_worker,
+                                          batch_size=opts.batch_size,
+                                          sync_every=opts.sync_every)
+            _, speed = throughput(lambda: trainer.fit(nb_row, nb_sample),
+                                  nb_sample, opts.nb_repeat)
+            model.set_weights(weights)
+            print('%d workers: %.1f samples/s' % (nb_worker, speed))
+        return 0
+
+    def bench_eval(self, data):
+        opts = self.opts
+        y = {k: v[:] for k, v in data.items() if k.endswith('_y')}
+        nb_sample = len(list(y.values())[0])
+        if opts.model:
+            model = npnet.model_from_list(opts.model)
+            ins = {k: data[k][:] for k in model.input_order}
+            z = npnet.predict_loop(model, ins, opts.batch_size, log=None)
+        else:
+            z = {k: np.random.rand(nb_sample).astype('float32') for k in y}
+        y = {k: y[k] for k in z.keys()}
+
+        def evaluate_serial():
+            # Metric functions called separately for each target
+            p = []
+            for k in sorted(z.keys()):
+                yk = y[k].ravel()
+                zk = z[k].ravel()
+                t = yk != io.MASK
+                yk = yk[t]
+                zk = zk[t]
+                e = {name: fun(yk, zk) for name, fun in ev.eval_funs}
+                e['n'] = len(yk)
+                p.append(e)
+            return pd.DataFrame(p, columns=[x for x, _ in ev.eval_funs] +
+                                ['n'])
+
+        self.log.info('Evaluate targets separately')
+        ref, speed = throughput(evaluate_serial, nb_sample, opts.nb_repeat)
+        print('serial: %.1f samples/s (%d targets)' % (speed, len(z)))
+        ok = True
+        for nb_worker in opts.nb_worker:
+            self.log.info('Evaluate targets in batches with %d workers' %
+                          (nb_worker))
+            e, speed = throughput(
+                lambda: ev.evaluate_all(y, z, mask=io.MASK,
+                                        nb_worker=nb_worker),
+                nb_sample, opts.nb_repeat)
+            print('%d workers: %.1f samples/s' % (nb_worker, speed))
+            e.index = range(len(e))
+            ok &= ev.eval_to_str(e) == ev.eval_to_str(ref)
+        if not ok:
+            self.log.error('Performance metrics differ!')
+            return 1
+        return 0
+
+    def main(self, name, opts):
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+            log.debug(opts)
+
+        if opts.seed is not None:
+            np.random.seed(opts.seed)
+        self.log = log
+
+        log.info('Load data')
+        data_file, data = io.read_hdf(opts.data_file, None)
+        io.to_view(data, stop=opts.nb_sample)
+
+        ret = getattr(self, 'bench_%s' % (opts.bench))(data)
+
+        data_file.close()
+        log.info('Done!')
+        return ret
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
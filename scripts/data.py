@@ -6,178 +6,10 @@ import logging
 import os.path as pt
 import h5py as h5
 import numpy as np
-import gc
 
 import deepcpg.utils as ut
-
-
-MAX_DIST = 10**6
-
-
-def read_anno(annos_file, chromo, name, pos=None):
-    f = h5.File(annos_file, 'r')
-    d = {k: f[pt.join(chromo, name, k)].value for k in ['pos', 'annos']}
-    f.close()
-    if pos is not None:
-        t = np.in1d(d['pos'], pos)
-        for k in d.keys():
-            d[k] = d[k][t]
-        assert np.all(d['pos'] == pos)
-    d['annos'][d['annos'] >= 0] = 1
-    d['annos'][d['annos'] < 0] = 0
-    d['annos'] = d['annos'].astype('bool')
-    return d['pos'], d['annos']
-
-
-def read_annos(annos_file, chromo, names, *args, **kwargs):
-    pos = None
-    annos = []
-    for name in names:
-        p, a = read_anno(annos_file, chromo, name, *args, **kwargs)
-        if pos is None:
-            pos = p
-        else:
-            assert np.all(pos == p)
-        annos.append(a)
-    annos = np.vstack(annos).T
-    return pos, annos
-
-
-def read_pos(path, chromo, nb_sample=None):
-    f = h5.File(path, 'r')
-    p = f['/cpg/%s/pos' % (chromo)]
-    if nb_sample:
-        p = p[:nb_sample]
-    else:
-        p = p.value
-    return p
-
-
-def read_pos_all(data_files, *args, **kwargs):
-    pos = [read_pos(x, *args, **kwargs) for x in data_files]
-    t = set()
-    for p in pos:
-        t.update(p)
-    pos = np.array(sorted(t))
-    return pos
-
-
-def adjust_pos(y, p, q):
-    yq = np.empty(len(q), dtype='int8')
-    yq.fill(ut.MASK)
-    t = np.in1d(q, p).nonzero()[0]
-    yq.flat[t] = y
-    return yq
-
-
-def read_cpg(path, chromo, pos=None):
-    f = h5.File(path, 'r')
-    p = f['/cpg/%s/pos' % (chromo)].value
-    c = f['/cpg/%s/cpg' % (chromo)].value
-    f.close()
-    if pos is not None:
-        c = adjust_pos(c, p, pos)
-        p = pos
-    c = c.astype('int8')
-    return c
-
-
-def read_knn(path, chromo, pos=None, what='knn', knn_group='knn_shared',
-             knn=None):
-    f = h5.File(path, 'r')
-    g = f['/%s/%s' % (knn_group, chromo)]
-    p = g['pos'].value
-    d = g[what]
-    if knn is None:
-        d = d.value
-    else:
-        assert knn % 2 == 0
-        assert knn <= d.shape[1]
-        c = d.shape[1] // 2
-        t = knn // 2
-        d = d[:, c-t:c+t]
-    f.close()
-    if pos is not None:
-        t = np.in1d(p, pos)
-        d = d[t]
-    return d
-
-
-def read_knn_dist(max_dist=MAX_DIST, *args, **kwargs):
-    d = read_knn(what='dist', *args, **kwargs)
-    d = np.array(np.minimum(max_dist, d) / max_dist, dtype='float16')
-    return d
-
-
-def read_knn_all(paths, *args, **kwargs):
-    d = [read_knn(x, *args, **kwargs) for x in paths]
-
-    T = len(d)  # targets
-    N = d[0].shape[0]  # samples
-    M = d[0].shape[1]  # win_len
-    C = 2  # features
-    d = np.hstack(d).reshape(N, T, M).reshape(-1)
-
-    t = [read_knn_dist(path=x, *args, **kwargs) for x in paths]
-    t = np.hstack(t).reshape(N, T, M).reshape(-1)
-
-    d = np.vstack((d, t)).T
-    del t
-    gc.collect()
-
-    d = d.reshape(N, T, M, C)  # combined
-    d = d.swapaxes(2, 3).swapaxes(1, 2)
-    assert d.shape == (N, C, T, M)
-    return d
-
-
-def encode_seqs(seqs, dim=4):
-    """Special nucleotides will be encoded as [0, 0, 0, 0]."""
-    n = seqs.shape[0]
-    l = seqs.shape[1]
-    #  t = seqs >= dim
-    #  seqs[t] = np.random.randint(0, dim, t.sum())
-    enc_seqs = np.zeros((n, l, dim), dtype='int8')
-    for i in range(dim):
-        t = seqs == i
-        enc_seqs[t, i] = 1
-    return enc_seqs
-
-
-def read_seq(path, chromo, pos=None, seq_len=None):
-    f = h5.File(path, 'r')
-    p = f['/%s/pos' % (chromo)].value
-    s = f['/%s/seq' % (chromo)]
-    if seq_len is None:
-        s = s.value
-    else:
-        assert seq_len % 2 == 1
-        assert seq_len <= s.shape[1]
-        c = s.shape[1] // 2
-        d = seq_len // 2
-        s = s[:, c-d:c+d+1]
-        assert s.shape[1] == seq_len
-    f.close()
-    if pos is not None:
-        t = np.in1d(p, pos)
-        p = p[t]
-        assert np.all(p == pos)
-        s = s[t]
-        assert s.shape[0] == len(pos)
-    return s
-
-
-def read_stat(stats_file, chromo, name, pos=None):
-    f = h5.File(stats_file, 'r')
-    g = f[chromo]
-    d = {k: g[k].value for k in [name, 'pos']}
-    f.close()
-    if pos is not None:
-        t = np.in1d(d['pos'], pos)
-        for k in d.keys():
-            d[k] = d[k][t]
-        assert np.all(d['pos'] == pos)
-    return d['pos'], d[name]
+import deepcpg.io as io
+import deepcpg.data as dat
 
 
 def chunk_size(shape, chunk_size):
@@ -306,6 +138,10 @@ class App(object):
             '--nb_sample',
             help='Limit # samples',
             type=int)
+        p.add_argument(
+            '--sparse_labels',
+            help='Store labels as sparse CSR matrix instead of dense datasets',
+            action='store_true')
         p.add_argument(
             '--shuffle',
             help='Shuffle sequences',
@@ -353,7 +189,7 @@ class App(object):
                 pos[chromo] = stats_file[chromo]['pos'].value
         else:
             for chromo in chromos:
-                pos[chromo] = read_pos_all(opts.cpg_targets, chromo,
+                pos[chromo] = dat.read_pos_all(opts.cpg_targets, chromo,
                                            nb_sample=opts.nb_sample)
         # Filter positions by annotations
         if opts.annos_file is not None:
@@ -364,7 +200,7 @@ class App(object):
             if opts.annos is not None:
                 names = ut.filter_regex(names, opts.annos)
             for chromo in chromos:
-                t, annos = read_annos(opts.annos_file, chromo, names,
+                t, annos = dat.read_annos(opts.annos_file, chromo, names,
                                       pos[chromo])
                 if opts.annos_op == 'or':
                     annos = annos.any(axis=1)
@@ -445,14 +281,38 @@ class App(object):
             t /= 10**6
             print('Chunk size: %d (%.2f MB)' % (chunk_out, t))
 
-        for t in target_ids:
-            s = (N, 1)
-            if t.startswith('c'):
-                dtype = 'int8'
+        if opts.sparse_labels:
+            # CSR matrix: labels of row i are data[indptr[i]:indptr[i + 1]]
+            # for targets indices[indptr[i]:indptr[i + 1]]
+            if opts.stats_file is not None:
+                label_dtype = 'float32'
             else:
-                dtype = 'float32'
-            fd.create_dataset('%s_y' % (t), shape=s, dtype=dtype,
-                              chunks=chunk_size(s, chunk_out))
+                label_dtype = 'int8'
+            fl = out_file.create_group('labels')
+            fl.create_dataset('indptr', shape=(N + 1,), dtype='int64',
+                              chunks=chunk_size((N + 1,), chunk_out),
+                              compression='gzip')
+            fl['indptr'][0] = 0
+            s = chunk_size((N,), chunk_out) or (2**14,)
+            fl.create_dataset('indices', shape=(0,), maxshape=(None,),
+                              dtype='int32', chunks=s, compression='gzip')
+            fl.create_dataset('data', shape=(0,), maxshape=(None,),
+                              dtype=label_dtype, chunks=s, compression='gzip')
+        else:
+            for t in target_ids:
+                s = (N, 1)
+                if t.startswith('c'):
+                    dtype = 'int8'
+                else:
+                    dtype = 'float32'
+                fd.create_dataset('%s_y' % (t), shape=s, dtype=dtype,
+                                  chunks=chunk_size(s, chunk_out))
+
+        # Label-coverage index: bit i of a row is set if target i is labeled
+        s = (N, int(np.ceil(nb_target / 8)))
+        out_file.create_dataset('/index/cov', shape=s, dtype='uint8',
+                                chunks=chunk_size(s, chunk_out),
+                                compression='gzip')
 
         if nb_knn is not None:
             s = (N, 2, nb_unit, nb_knn)
@@ -482,20 +342,49 @@ class App(object):
             fp['chromo'][s:e] = chromo.encode()
 
             log.info('Write targets')
+            # Bits of labeled targets packed as by np.packbits
+            cov = np.zeros((Nc, int(np.ceil(nb_target / 8))), dtype='uint8')
+            # Rows, targets, and labels of labeled sites
+            csr = []
             for i in range(nb_target):
                 target_id = target_ids[i]
                 target_name = target_names[i]
                 target_file = target_files[i]
                 if target_id.startswith('s'):
-                    t, d = read_stat(target_file, chromo, target_name, cpos)
+                    t, d = dat.read_stat(target_file, chromo, target_name,
+                                         cpos)
                     assert np.all((d >= 0) & (d <= 1))
                 else:
-                    d = read_cpg(target_file, chromo, cpos)
+                    d = dat.read_cpg(target_file, chromo, cpos)
                     if nb_target == 1:
                         assert np.all((d == 0) | (d == 1))
                     else:
-                        assert np.all((d == 0) | (d == 1) | (d == ut.MASK))
-                fd['%s_y' % (target_id)][s:e, 0] = d[shuffle.argsort()]
+                        assert np.all((d == 0) | (d == 1) | (d == io.MASK))
+                d = d[shuffle.argsort()]
+                rows = np.nonzero(d != io.MASK)[0]
+                cov[rows, i // 8] |= np.uint8(128 >> (i % 8))
+                if opts.sparse_labels:
+                    csr.append((rows, np.repeat(np.int32(i), len(rows)),
+                                d[rows].astype(label_dtype)))
+                else:
+                    fd['%s_y' % (target_id)][s:e, 0] = d
+            if opts.sparse_labels:
+                rows, cols, y = [np.concatenate(x) for x in zip(*csr)]
+                del csr
+                # Sort by rows, keeping targets of rows in order
+                t = np.argsort(rows, kind='mergesort')
+                fl = out_file['labels']
+                n = fl['indptr'][s]
+                fl['indptr'][s + 1:e + 1] = n + np.cumsum(
+                    np.bincount(rows, minlength=Nc))
+                m = n + len(rows)
+                fl['indices'].resize((m,))
+                fl['indices'][n:m] = cols[t]
+                fl['data'].resize((m,))
+                fl['data'][n:m] = y[t]
+                del rows, cols, y
+            out_file['/index/cov'][s:e] = cov
+            del cov
 
             if nb_knn is not None:
                 chunk = 0
@@ -504,7 +393,7 @@ class App(object):
                     chunk += 1
                     log.info('Read KNN (%d/%d)' % (chunk, nb_chunk_in))
                     j = i + opts.chunk_in
-                    d = read_knn_all(opts.cpg_knn, chromo=chromo,
+                    d = dat.read_knn_all(opts.cpg_knn, chromo=chromo,
                                      pos=cpos[i:j],
                                      knn_group=opts.knn_group,
                                      knn=nb_knn)
@@ -520,7 +409,7 @@ class App(object):
             if seq_len is not None:
                 log.info('Read seq')
                 # Read integer sequence (not one-hot encoded)
-                ds = read_seq(opts.seq_file, chromo, cpos, seq_len=seq_len)
+                ds = dat.read_seq(opts.seq_file, chromo, cpos, seq_len=seq_len)
                 chunk = 0
                 nb_chunk_in = int(np.ceil(ds.shape[0] / opts.chunk_in))
                 # Encode sequence in chunks to reduce storage
@@ -528,7 +417,7 @@ class App(object):
                     chunk += 1
                     log.info('Write seq (%d/%d)' % (chunk, nb_chunk_in))
                     j = i + opts.chunk_in
-                    d = encode_seqs(ds[i:j])
+                    d = dat.encode_seqs(ds[i:j])
                     j = i + d.shape[0]
                     k = shuffle[i:j]
                     t = list(s + np.sort(k))
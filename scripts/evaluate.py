@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import logging
+import os.path as pt
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import h5py as h5
+
+import deepcpg.io as io
+import deepcpg.evaluation as ev
+import deepcpg.utils as ut
+
+
+_opts = None
+
+
+def eval_group(task):
+    """Returns evaluators of target and chromosome group of prediction
+    file, one for each annotation if evaluated by annotation."""
+    path, target, chromo = task
+    opts = _opts
+    f = h5.File(path, 'r')
+    g = f[target][chromo]
+    pos = g['pos'][:]
+    y = g['y'][:]
+    z = io.dequantize(g[opts.name][:])
+    f.close()
+
+    t = np.ones(len(pos), dtype='bool')
+    if opts.start is not None:
+        t &= pos >= opts.start
+    if opts.end is not None:
+        t &= pos <= opts.end
+
+    annos = [None]
+    if opts.anno_index is not None:
+        index = io.AnnoIndex(opts.anno_index)
+        names = ut.filter_regex(index.names, opts.annos or ['.*'])
+        bits = index.lookup(chromo, pos)
+        bits = bits[:, [index.names.index(x) for x in names]]
+        index.close()
+        if opts.by_anno:
+            annos = names
+        elif opts.annos_op == 'or':
+            t &= bits.any(axis=1)
+        else:
+            t &= bits.all(axis=1)
+
+    evals = []
+    for i, anno in enumerate(annos):
+        ta = t
+        if anno is not None:
+            ta = t & bits[:, i]
+        e = ev.StreamEvaluator([target], mask=io.MASK, funs=opts.funs,
+                               nb_bin=opts.nb_bin)
+        e.update({target: y[ta]}, {target: z[ta]})
+        evals.append(((path, target, chromo, anno), e))
+    return evals
+
+
+class App(object):
+
+    def run(self, args):
+        name = pt.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        self.opts = opts
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Evaluates prediction files')
+        p.add_argument(
+            'z_files',
+            help='Prediction files written by write_z',
+            nargs='+')
+        p.add_argument(
+            '-o', '--out_file',
+            help='Output file')
+        p.add_argument(
+            '--targets',
+            help='Regex of targets to be evaluated',
+            nargs='+')
+        p.add_argument(
+            '--chromos',
+            help='Only evaluate chromosomes',
+            nargs='+')
+        p.add_argument(
+            '--start',
+            help='Start position',
+            type=int)
+        p.add_argument(
+            '--end',
+            help='End position',
+            type=int)
+        p.add_argument(
+            '--anno_index',
+            help='Annotation index written by anno_index.py')
+        p.add_argument(
+            '--annos',
+            help='Regex of annotations',
+            nargs='+')
+        p.add_argument(
+            '--annos_op',
+            help='Only evaluate sites in any (or) or all (and) annotations',
+            choices=['or', 'and'],
+            default='or')
+        p.add_argument(
+            '--by_anno',
+            help='Evaluate each annotation separately',
+            action='store_true')
+        p.add_argument(
+            '--by_chromo',
+            help='Evaluate each chromosome separately',
+            action='store_true')
+        p.add_argument(
+            '--regress',
+            help='Evaluate regression instead of classification metrics',
+            action='store_true')
+        p.add_argument(
+            '--nb_bin',
+            help='# histogram bins for approximating AUC (0: exact)',
+            type=int,
+            default=0)
+        p.add_argument(
+            '--name',
+            help='Name of predictions dataset',
+            default='z')
+        p.add_argument(
+            '--nb_worker',
+            help='# worker processes',
+            type=int,
+            default=1)
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def tasks(self):
+        opts = self.opts
+        tasks = []
+        for path in opts.z_files:
+            f = h5.File(path, 'r')
+            targets = list(f.keys())
+            if opts.targets is not None:
+                targets = ut.filter_regex(targets, opts.targets)
+            for target in targets:
+                for chromo in f[target].keys():
+                    if opts.chromos is None or chromo in opts.chromos:
+                        tasks.append((path, target, chromo))
+            f.close()
+        return tasks
+
+    def main(self, name, opts):
+        global _opts
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+            log.debug(opts)
+
+        if opts.by_anno and opts.anno_index is None:
+            raise ValueError('Annotation index required!')
+        if opts.anno_index is not None:
+            index = io.AnnoIndex(opts.anno_index)
+            names = ut.filter_regex(index.names, opts.annos or ['.*'])
+            index.close()
+            if len(names) == 0:
+                raise ValueError('No annotations match selection!')
+        if opts.regress:
+            opts.funs = ev.eval_funs_regress
+        else:
+            opts.funs = ev.eval_funs
+        _opts = opts
+
+        tasks = self.tasks()
+        if len(tasks) == 0:
+            raise ValueError('No targets match selection!')
+        log.info('Evaluate %d groups' % (len(tasks)))
+        if opts.nb_worker > 1:
+            pool = mp.get_context('fork').Pool(opts.nb_worker)
+            evals = pool.map(eval_group, tasks, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            evals = [eval_group(task) for task in tasks]
+
+        # Merge evaluators of chromosomes
+        merged = dict()
+        for key, e in [x for group in evals for x in group]:
+            path, target, chromo, anno = key
+            if not opts.by_chromo:
+                chromo = None
+            key = (path, target, chromo, anno)
+            if key in merged:
+                merged[key].merge(e)
+            else:
+                merged[key] = e
+
+        p = []
+        for (path, target, chromo, anno), e in merged.items():
+            d = e.evaluate()
+            d.insert(0, 'target', target)
+            if opts.by_chromo:
+                d.insert(1, 'chromo', chromo)
+            if opts.by_anno:
+                d.insert(1, 'anno', anno)
+            if len(opts.z_files) > 1:
+                d.insert(0, 'file', path)
+            p.append(d)
+        p = pd.concat(p)
+        cols = [x for x in ['file', 'target', 'anno', 'chromo']
+                if x in p.columns]
+        p.sort_values(cols, inplace=True)
+
+        print(p.to_string(index=False))
+        if opts.out_file is not None:
+            ev.eval_to_file(p, opts.out_file)
+        log.info('Done!')
+
+        return 0
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import logging
+import os.path as pt
+import numpy as np
+import h5py as h5
+from time import time
+
+import deepcpg.io as io
+import deepcpg.utils as ut
+import deepcpg.npnet as npnet
+from deepcpg.mutagenesis import Mutagenesis
+
+
+class App(object):
+
+    def run(self, args):
+        name = pt.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        self.opts = opts
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Scores effects of single-nucleotide substitutions')
+        p.add_argument(
+            'data_file',
+            help='Data file')
+        p.add_argument(
+            '--model',
+            help='Model files',
+            nargs='+')
+        p.add_argument(
+            '-o', '--out_file',
+            help='Output file',
+            default='mutagenesis.h5')
+        p.add_argument(
+            '--win_len',
+            help='Only mutate central window of this length',
+            type=int)
+        p.add_argument(
+            '--chromo',
+            help='Chromosome')
+        p.add_argument(
+            '--start',
+            help='Start position',
+            type=int)
+        p.add_argument(
+            '--end',
+            help='End position',
+            type=int)
+        p.add_argument(
+            '--nb_sample',
+            help='Maximum # sites',
+            type=int)
+        p.add_argument(
+            '--nb_site',
+            help='# sites scored together',
+            type=int,
+            default=16)
+        p.add_argument(
+            '--batch_size',
+            help='# variants per forward pass',
+            type=int,
+            default=1024)
+        p.add_argument(
+            '--out_dtype',
+            help='Data type of effects',
+            choices=['float32', 'float16'],
+            default='float16')
+        p.add_argument(
+            '--seed',
+            help='Seed of rng',
+            type=int,
+            default=0)
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def main(self, name, opts):
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+            log.debug(opts)
+
+        if opts.seed is not None:
+            np.random.seed(opts.seed)
+
+        log.info('Load model')
+        model = npnet.model_from_list(opts.model)
+        mutate = Mutagenesis(model, opts.win_len, opts.batch_size)
+
+        log.info('Load data')
+        data_file, data = io.read_hdf(opts.data_file, None)
+        data = {k: data[k] for k in model.input_order + ['chromo', 'pos']}
+        if opts.chromo is not None:
+            io.select_cpos(data, opts.chromo, opts.start, opts.end)
+        io.to_view(data, stop=opts.nb_sample)
+        nb_sample = len(data['pos'])
+        seq_len = data['s_x'].shape[1]
+        w0, w1 = mutate.window(seq_len)
+        nb_target = len(model.output_order)
+        print('%d sites' % (nb_sample))
+        print('%d variants' % (nb_sample * (w1 - w0) * 3))
+
+        out_file = h5.File(opts.out_file, 'w')
+        out_file['targets'] = np.array([x.encode()
+                                        for x in model.output_order])
+        out_file['chromo'] = data['chromo'][:]
+        out_file['pos'] = data['pos'][:]
+        out_file.attrs['start'] = w0
+        zs = out_file.create_dataset('z', (nb_sample, nb_target),
+                                     dtype='float32')
+        effects = out_file.create_dataset(
+            'effect', (nb_sample, w1 - w0, 4, nb_target),
+            dtype=opts.out_dtype, chunks=(1, w1 - w0, 4, nb_target),
+            compression='gzip')
+
+        log.info('Score variants')
+        t = time()
+        nb_variant = 0
+        batches = ut.make_batches(nb_sample, opts.nb_site)
+        for batch, (start, end) in enumerate(batches):
+            s = ut.progress(batch, len(batches))
+            if s is not None:
+                print(s)
+            ins = {k: data[k][start:end] for k in model.input_order}
+            z, effect = mutate(ins)
+            zs[start:end] = z
+            effects[start:end] = effect
+            nb_variant += (ins['s_x'][:, w0:w1] == 0).sum()
+        t = time() - t
+        print('%.1f variants/s' % (nb_variant / t))
+
+        out_file.close()
+        data_file.close()
+        log.info('Done!')
+
+        return 0
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
@@ -8,11 +8,15 @@ import pandas as pd
 import numpy as np
 
 import deepcpg.io as io
-import deepcpg.net as net
+import deepcpg.utils as ut
+import deepcpg.data as dat
+import deepcpg.npnet as npnet
 
 
 def select_data(data, chromo, start=None, end=None):
-    sel = data['chromo'].value == str(chromo).encode()
+    if not isinstance(chromo, list):
+        chromo = [chromo]
+    sel = np.in1d(data['chromo'].value, [str(x).encode() for x in chromo])
     if start is not None:
         sel &= data['pos'].value >= start
     if end is not None:
@@ -41,14 +45,81 @@ class App(object):
             description='Make prediction on data set')
         p.add_argument(
             'data_file',
-            help='Data file')
+            help='Data file. Inputs are built from --cpg_knn and ' +
+                 '--seq_file if not given.',
+            nargs='?')
+        p.add_argument(
+            '--cpg_knn',
+            help='CpG files to be used as knn',
+            nargs='+')
+        p.add_argument(
+            '--knn',
+            help='Max # CpGs',
+            type=int)
+        p.add_argument(
+            '--knn_group',
+            help='Name of knn group in HDF file',
+            default='knn_shared')
+        p.add_argument(
+            '--seq_file',
+            help='HDF path to seq file')
+        p.add_argument(
+            '--seq_len',
+            help='Sequence length',
+            type=int)
+        p.add_argument(
+            '--target_names',
+            help='Names of model outputs if no data file given',
+            nargs='+')
         p.add_argument(
             '--model',
             help='Model files',
             nargs='+')
+        p.add_argument(
+            '--engine',
+            help='Use compiled Keras model or pure NumPy forward pass',
+            choices=['keras', 'numpy'],
+            default='keras')
+        p.add_argument(
+            '--mc_dropout',
+            help='Write mean (z) and variance (z_var) of this many ' +
+                 'predictions with active dropout (NumPy engine only)',
+            type=int)
+        p.add_argument(
+            '--sliding',
+            help='Convolve sequence of neighboring CpG sites only once ' +
+                 '(NumPy engine)',
+            action='store_true')
         p.add_argument(
             '-o', '--out_file',
             help='Output file')
+        p.add_argument(
+            '--out_format',
+            help='Write predictions per target (group) or as sites x ' +
+                 'targets matrix per chromosome (matrix)',
+            choices=['group', 'matrix'],
+            default='group')
+        p.add_argument(
+            '--out_dtype',
+            help='Data type of predictions. uint8 quantizes probabilities ' +
+                 'to 256 levels.',
+            choices=['float32', 'float16', 'uint8'],
+            default='float32')
+        p.add_argument(
+            '--compression',
+            help='HDF compression of output file. gzip shrinks files most' +
+            ' but slows down writing and reading; lzf is faster',
+            choices=['gzip', 'lzf', 'none'],
+            default='none')
+        p.add_argument(
+            '--block_size',
+            help='# samples predicted and written at once',
+            type=int,
+            default=10**5)
+        p.add_argument(
+            '--resume',
+            help='Resume after last block written to output file',
+            action='store_true')
         p.add_argument(
             '--batch_size',
             help='Batch size',
@@ -64,7 +135,8 @@ class App(object):
             action='store_true')
         p.add_argument(
             '--chromo',
-            help='Chromosome')
+            help='Chromosomes',
+            nargs='+')
         p.add_argument(
             '--start',
             help='Start position',
@@ -92,6 +164,120 @@ class App(object):
             help='Write log messages to file')
         return p
 
+    def writer(self, targets, *args, **kwargs):
+        opts = self.opts
+        if opts.out_format == 'matrix':
+            writer = io.ZMatrixWriter
+        else:
+            writer = io.ZWriter
+        compression = opts.compression
+        if compression == 'none':
+            compression = None
+        if pt.isfile(opts.out_file) and not opts.resume:
+            self.log.warning('Overwriting %s!' % (opts.out_file))
+        # Selection of sites must match when resuming
+        region = dict(chromo=' '.join(opts.chromo or []),
+                      start=-1 if opts.start is None else opts.start,
+                      end=-1 if opts.end is None else opts.end)
+        return writer(opts.out_file, targets, *args, dtype=opts.out_dtype,
+                      resume=opts.resume, compression=compression,
+                      block_size=opts.block_size,
+                      out_format=opts.out_format,
+                      mc_dropout=opts.mc_dropout or 0, **region, **kwargs)
+
+    def predict_file(self, model, predict):
+        opts = self.opts
+        log = self.log
+        log.info('Load data')
+        targets = io.read_targets(opts.data_file)
+        data_file, data = io.read_hdf(opts.data_file, opts.max_mem)
+        index = None
+        if opts.labeled_only:
+            index = io.read_coverage(data_file, model.output_order)
+            if index is not None:
+                log.info('Skip %d unlabeled sites' %
+                         (len(data['pos']) - len(index)))
+        if opts.chromo is not None:
+            log.info('Select data')
+            sel = select_data(data, opts.chromo, opts.start, opts.end)
+            if index is not None:
+                index = np.nonzero(np.in1d(np.nonzero(sel)[0], index))[0]
+            log.info('%d sites selected' % (len(data['pos'])))
+        io.to_view(data, stop=opts.nb_sample, index=index)
+
+        nb_sample = list(data.values())[0].shape[0]
+        print('%d samples' % (nb_sample))
+        print()
+
+        writer = self.writer(targets, unlabeled=not opts.labeled_only,
+                             nb_sample=nb_sample)
+        blocks = ut.make_batches(nb_sample, opts.block_size)
+        for block, (start, end) in enumerate(blocks):
+            if block in writer.done:
+                continue
+            log.info('Block %d/%d' % (block + 1, len(blocks)))
+            data_block = {k: v[start:end] for k, v in data.items()}
+            writer.write(data_block, *predict(data_block))
+            writer.commit(block)
+        writer.close()
+        data_file.close()
+
+    def impute(self, model, predict):
+        """Predict from input features built in memory."""
+        opts = self.opts
+        log = self.log
+        if opts.cpg_knn is None and opts.seq_file is None:
+            raise IOError('No input given')
+        if opts.chromo is None:
+            raise ValueError('Chromosomes required!')
+        if opts.labeled_only:
+            raise ValueError('No labels without data file!')
+
+        ids = [x.replace('_y', '') for x in model.output_order]
+        names = opts.target_names
+        if names is None:
+            names = ids
+        elif len(names) != len(ids):
+            raise ValueError('%d target names required!' % (len(ids)))
+        targets = {'id': ids, 'name': names}
+
+        writer = self.writer(targets, unlabeled=True)
+        block = 0
+        nb_sample = opts.nb_sample
+        for chromo in opts.chromo:
+            log.info('Chromosome %s' % (chromo))
+            pos = dat.read_input_pos(chromo, opts.cpg_knn, opts.seq_file,
+                                     opts.knn_group)
+            if opts.start is not None:
+                pos = pos[pos >= opts.start]
+            if opts.end is not None:
+                pos = pos[pos <= opts.end]
+            if nb_sample is not None:
+                pos = pos[:nb_sample]
+                nb_sample -= len(pos)
+            print('%d samples' % (len(pos)))
+
+            blocks = [pos[i:i + opts.block_size]
+                      for i in range(0, len(pos), opts.block_size)]
+            rows = dat.block_rows(chromo, blocks, opts.cpg_knn,
+                                  opts.seq_file, opts.knn_group)
+            for i, pos_block in enumerate(blocks):
+                if block not in writer.done:
+                    log.info('Block %d' % (block + 1))
+                    data = dat.read_inputs(chromo, pos_block,
+                                           opts.cpg_knn, opts.seq_file,
+                                           knn_group=opts.knn_group,
+                                           knn=opts.knn, seq_len=opts.seq_len,
+                                           rows=rows[i])
+                    z, extra = predict(data)
+                    for k in model.output_order:
+                        data[k] = np.empty(len(data['pos']), dtype='int8')
+                        data[k].fill(io.MASK)
+                    writer.write(data, z, extra)
+                    writer.commit(block)
+                block += 1
+        writer.close()
+
     def main(self, name, opts):
         logging.basicConfig(filename=opts.log_file,
                             format='%(levelname)s (%(asctime)s): %(message)s')
@@ -105,36 +291,45 @@ class App(object):
         if opts.seed is not None:
             np.random.seed(opts.seed)
         pd.set_option('display.width', 150)
+        self.log = log
 
-        log.info('Load model')
-        model = net.model_from_list(opts.model)
+        if opts.sliding and opts.engine != 'numpy':
+            raise ValueError('--sliding requires NumPy engine!')
+        if opts.mc_dropout and opts.engine != 'numpy':
+            raise ValueError('--mc_dropout requires NumPy engine!')
 
-        log.info('Load data')
-        targets = io.read_targets(opts.data_file)
-        data_file, data = io.read_hdf(opts.data_file, opts.max_mem)
-        if opts.chromo is not None:
-            log.info('Select data')
-            select_data(data, opts.chromo, opts.start, opts.end)
-            log.info('%d sites selected' % (len(data['pos'])))
-        io.to_view(data, stop=opts.nb_sample)
-
-        print('%d samples' % (list(data.values())[0].shape[0]))
-        print()
+        log.info('Load model')
+        if opts.engine == 'numpy':
+            model = npnet.model_from_list(opts.model)
+        else:
+            # Keras requires Theano, which is not needed for NumPy engine
+            import deepcpg.net as net
+            model = net.model_from_list(opts.model)
 
         def progress(*args, **kwargs):
-            h = net.progress(*args, **kwargs)
+            h = ut.progress(*args, **kwargs)
             if h is not None:
                 print(h)
 
-        log.info('Predict')
-        z = model.predict(data, verbose=opts.verbose,
-                          callbacks=[progress],
-                          batch_size=opts.batch_size)
-        log.info('Write')
-        io.write_z(data, z, targets, opts.out_file,
-                   unlabeled=not opts.labeled_only)
+        def predict(data):
+            """Returns predictions and dict of further predictions."""
+            if opts.engine != 'numpy':
+                z = model.predict(data, verbose=opts.verbose,
+                                  callbacks=[progress],
+                                  batch_size=opts.batch_size)
+                return (z, dict())
+            z = npnet.predict_loop(model, data, batch_size=opts.batch_size,
+                                   callbacks=[progress], log=None,
+                                   sliding=opts.sliding,
+                                   mc_dropout=opts.mc_dropout)
+            if opts.mc_dropout:
+                return (z[0], {'z_var': z[1]})
+            return (z, dict())
 
-        data_file.close()
+        if opts.data_file is None:
+            self.impute(model, predict)
+        else:
+            self.predict_file(model, predict)
         log.info('Done!')
 
         return 0
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import logging
+import os
+import os.path as pt
+import shlex
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+import yaml
+import scipy.stats as sps
+
+from deepcpg.net_params import ParamSampler
+
+
+class Distribution(object):
+    """Wraps `scipy.stats` distribution to sample Python scalars."""
+
+    def __init__(self, dist):
+        self.dist = dist
+
+    def rvs(self):
+        return self.dist.rvs().item()
+
+
+def read_param_dist(path):
+    """Reads parameter distributions from YAML file.
+
+    Lists are sampled uniformly, and dicts with key `dist` are replaced by
+    `scipy.stats` distributions, e.g. {dist: uniform, args: [0, 0.5]}.
+    """
+    def convert(d):
+        if isinstance(d, dict):
+            if 'dist' in d:
+                dist = getattr(sps, d['dist'])(*d.get('args', []))
+                return Distribution(dist)
+            return {k: convert(v) for k, v in d.items()}
+        return d
+
+    with open(path, 'r') as f:
+        return convert(yaml.load(f.read()))
+
+
+def flatten_params(params, prefix=''):
+    flat = dict()
+    for k, v in vars(params).items():
+        if hasattr(v, '__dict__'):
+            flat.update(flatten_params(v, prefix + k + '.'))
+        elif isinstance(v, dict):
+            for kk, vv in v.items():
+                flat['%s%s.%s' % (prefix, k, kk)] = vv
+        elif isinstance(v, list):
+            flat[prefix + k] = ','.join([str(x) for x in v])
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def read_val_loss(out_dir):
+    """Returns minimum validation loss of learning curve in `out_dir`."""
+    h = pt.join(out_dir, 'lc.csv')
+    if not pt.isfile(h):
+        return np.nan
+    lc = pd.read_csv(h, sep='\t')
+    if 'val_loss' not in lc.columns or len(lc) == 0:
+        return np.nan
+    return lc['val_loss'].min()
+
+
+class App(object):
+
+    def run(self, args):
+        name = pt.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        self.opts = opts
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Hyperparameter search with successive halving')
+        p.add_argument(
+            'train_file',
+            help='Training data file')
+        p.add_argument(
+            '--val_file',
+            help='Validation data file')
+        p.add_argument(
+            '-o', '--out_dir',
+            help='Output directory',
+            default='.')
+        p.add_argument(
+            '--param_dist',
+            help='YAML file with parameter distributions',
+            required=True)
+        p.add_argument(
+            '--nb_config',
+            help='# sampled configurations',
+            type=int,
+            default=16)
+        p.add_argument(
+            '--nb_job',
+            help='# configurations trained concurrently',
+            type=int,
+            default=2)
+        p.add_argument(
+            '--min_epoch',
+            help='# epochs of first round',
+            type=int,
+            default=1)
+        p.add_argument(
+            '--max_epoch',
+            help='Maximum # epochs',
+            type=int,
+            default=27)
+        p.add_argument(
+            '--eta',
+            help='Keep best 1/eta configurations and train eta times longer' +
+            ' each round',
+            type=int,
+            default=3)
+        p.add_argument(
+            '--train_args',
+            help='Additional arguments of train.py',
+            default='')
+        p.add_argument(
+            '--train_script',
+            help='Training script',
+            default=pt.join(pt.dirname(pt.abspath(__file__)), 'train.py'))
+        p.add_argument(
+            '--poll',
+            help='Seconds between checking jobs',
+            type=float,
+            default=5)
+        p.add_argument(
+            '--seed',
+            help='Seed of rng',
+            type=int,
+            default=0)
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def command(self, config_dir, nb_epoch, seed):
+        opts = self.opts
+        cmd = [sys.executable, opts.train_script, opts.train_file,
+               '--params', pt.join(config_dir, 'configs.yaml'),
+               '--out_dir', config_dir,
+               '--nb_epoch', str(nb_epoch),
+               '--seed', str(seed),
+               '--resume', '--eval', '--out_pickle']
+        if opts.val_file is not None:
+            cmd += ['--val_file', opts.val_file]
+        cmd += shlex.split(opts.train_args)
+        return cmd
+
+    def run_jobs(self, jobs):
+        """Runs commands of `jobs` with at most `nb_job` at a time.
+
+        Jobs read the same data files, which are shared between processes
+        through the page cache of the OS.
+        """
+        jobs = list(jobs)
+        running = []
+        codes = dict()
+        while len(jobs) or len(running):
+            while len(jobs) and len(running) < self.opts.nb_job:
+                name, cmd, log_file = jobs.pop(0)
+                self.log.debug(' '.join(cmd))
+                f = open(log_file, 'a')
+                proc = subprocess.Popen(cmd, stdout=f,
+                                        stderr=subprocess.STDOUT)
+                running.append((name, proc, f))
+            time.sleep(self.opts.poll)
+            for job in list(running):
+                name, proc, f = job
+                if proc.poll() is not None:
+                    f.close()
+                    codes[name] = proc.returncode
+                    running.remove(job)
+                    if proc.returncode:
+                        self.log.warning('%s failed with code %d!' %
+                                         (name, proc.returncode))
+        return codes
+
+    def main(self, name, opts):
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+            log.debug(opts)
+
+        if opts.seed is not None:
+            np.random.seed(opts.seed)
+        self.log = log
+
+        os.makedirs(opts.out_dir, exist_ok=True)
+
+        log.info('Sample configurations')
+        param_dist = read_param_dist(opts.param_dist)
+        configs = []
+        for i, params in enumerate(ParamSampler(param_dist, opts.nb_config)):
+            config = 'config%03d' % (i)
+            config_dir = pt.join(opts.out_dir, config)
+            os.makedirs(config_dir, exist_ok=True)
+            params.to_yaml(pt.join(config_dir, 'configs.yaml'))
+            configs.append((config, config_dir, flatten_params(params)))
+
+        results = []
+        alive = configs
+        nb_epoch = opts.min_epoch
+        rnd = 0
+        while True:
+            log.info('Round %d: train %d configurations for %d epochs' %
+                     (rnd, len(alive), nb_epoch))
+            jobs = []
+            for config, config_dir, _ in alive:
+                cmd = self.command(config_dir, nb_epoch, opts.seed)
+                jobs.append((config, cmd, pt.join(config_dir, 'train.log')))
+            codes = self.run_jobs(jobs)
+
+            scores = []
+            for config, config_dir, params in alive:
+                val_loss = read_val_loss(config_dir)
+                if codes[config] or np.isnan(val_loss):
+                    val_loss = np.inf
+                result = {'config': config, 'round': rnd,
+                          'nb_epoch': nb_epoch, 'val_loss': val_loss,
+                          'code': codes[config]}
+                result.update(params)
+                results.append(result)
+                scores.append(val_loss)
+
+            t = pd.DataFrame(results)
+            cols = ['config', 'round', 'nb_epoch', 'val_loss', 'code']
+            t = t[cols + sorted([x for x in t.columns if x not in cols])]
+            t.to_csv(pt.join(opts.out_dir, 'results.csv'), sep='\t',
+                     index=False)
+
+            if len(alive) <= 1 or nb_epoch >= opts.max_epoch:
+                break
+            nb_keep = int(np.ceil(len(alive) / opts.eta))
+            alive = [alive[i] for i in np.argsort(scores, kind='mergesort')]
+            alive = alive[:nb_keep]
+            nb_epoch = min(nb_epoch * opts.eta, opts.max_epoch)
+            rnd += 1
+
+        t = t.loc[t['round'] == rnd].sort_values('val_loss')
+        print('\nBest configurations:')
+        print(t[['config', 'nb_epoch', 'val_loss']].to_string(index=False))
+        log.info('Done!')
+
+        return 0
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import logging
+import os.path as pt
+import numpy as np
+
+import deepcpg.npnet as npnet
+import deepcpg.server as srv
+
+
+class App(object):
+
+    def run(self, args):
+        name = pt.basename(args[0])
+        parser = self.create_parser(name)
+        opts = parser.parse_args(args[1:])
+        self.opts = opts
+        return self.main(name, opts)
+
+    def create_parser(self, name):
+        p = argparse.ArgumentParser(
+            prog=name,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description='Serve predictions over HTTP')
+        p.add_argument(
+            '--model',
+            help='Model files',
+            nargs='+')
+        p.add_argument(
+            '--engine',
+            help='Use compiled Keras model or pure NumPy forward pass',
+            choices=['keras', 'numpy'],
+            default='keras')
+        p.add_argument(
+            '--host',
+            help='Host name',
+            default='localhost')
+        p.add_argument(
+            '--port',
+            help='Port',
+            type=int,
+            default=8000)
+        p.add_argument(
+            '--max_batch',
+            help='Maximum # samples coalesced into one batch',
+            type=int,
+            default=1024)
+        p.add_argument(
+            '--max_latency',
+            help='Maximum time in ms requests wait for being batched',
+            type=float,
+            default=10)
+        p.add_argument(
+            '--batch_size',
+            help='Batch size',
+            type=int,
+            default=128)
+        p.add_argument(
+            '--seed',
+            help='Seed of rng',
+            type=int,
+            default=0)
+        p.add_argument(
+            '--verbose',
+            help='More detailed log messages',
+            action='store_true')
+        p.add_argument(
+            '--log_file',
+            help='Write log messages to file')
+        return p
+
+    def main(self, name, opts):
+        logging.basicConfig(filename=opts.log_file,
+                            format='%(levelname)s (%(asctime)s): %(message)s')
+        log = logging.getLogger(name)
+        if opts.verbose:
+            log.setLevel(logging.DEBUG)
+        else:
+            log.setLevel(logging.INFO)
+            log.debug(opts)
+
+        if opts.seed is not None:
+            np.random.seed(opts.seed)
+
+        log.info('Load model')
+        if opts.engine == 'numpy':
+            model = npnet.model_from_list(opts.model)
+            shapes = model.input_shapes
+
+            def predict(data):
+                return npnet.predict_loop(model, data, opts.batch_size,
+                                          log=None)
+        else:
+            import deepcpg.net as net
+            model = net.model_from_list(opts.model)
+            shapes = {k: model.inputs[k].input_shape[1:]
+                      for k in model.input_order}
+
+            def predict(data):
+                return net.predict_loop(model, data, opts.batch_size,
+                                        log=None)
+
+        batcher = srv.Batcher(predict, model.input_order, shapes=shapes,
+                              max_batch=opts.max_batch,
+                              max_latency=opts.max_latency / 1000)
+        server = srv.Server(batcher, opts.host, opts.port, log=log.debug)
+        log.info('Serving on http://%s:%d' % (opts.host, opts.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        log.info('Done!')
+
+        return 0
+
+
+if __name__ == '__main__':
+    app = App()
+    app.run(sys.argv)
@@ -10,13 +10,15 @@ import numpy as np
 import h5py as h5
 import random
 import re
-from keras.callbacks import ModelCheckpoint
+import pickle
+from time import time
 
 import deepcpg.evaluation as ev
 import deepcpg.utils as ut
 import deepcpg.io as io
 import deepcpg.net as net
 import deepcpg.callbacks as cb
+import deepcpg.parallel as par
 from deepcpg.net_params import Params
 
 import matplotlib
@@ -25,25 +27,18 @@ import seaborn as sns
 sns.set_style('darkgrid')
 
 
-def get_sample_weights(y, weight_classes=False):
-    y = y[:]
-    class_weights = {io.MASK: 0}
-    if weight_classes:
-        t = y[y != io.MASK].mean()
-        class_weights[0] = t
-        class_weights[1] = 1 - t
-    sample_weights = np.ones(y.shape, dtype='float16')
-    for k, v in class_weights.items():
-        sample_weights[y == k] = v
-    return sample_weights
-
-
-def check_weights(model, y, weights):
-    for output in model.output_order:
-        h = y[output][:] == io.MASK
-        w = weights[output][:]
-        assert np.all(w[h] == 0)
-        assert np.all(w[~h] == 1)
+def get_class_weights(y, weight_classes=False, chunk_size=10**6):
+    if not weight_classes:
+        return None
+    n = 0
+    t = 0
+    for i in range(0, y.shape[0], chunk_size):
+        yc = y[i:i + chunk_size]
+        yc = yc[yc != io.MASK]
+        n += len(yc)
+        t += yc.sum()
+    t /= max(n, 1)
+    return {0: t, 1: 1 - t}
 
 
 def perf_logs_str(logs):
@@ -51,8 +46,7 @@ def perf_logs_str(logs):
     return t
 
 
-def evaluate(y, z, targets, *args, **kwargs):
-    p = ev.evaluate_all(y, z, *args, **kwargs)
+def eval_frame(p, targets):
     p.index = io.target_id2name(p.index.values, targets)
     p.index.name = 'target'
     p.reset_index(inplace=True)
@@ -60,10 +54,12 @@ def evaluate(y, z, targets, *args, **kwargs):
     return p
 
 
-def eval_io(model, y, z, out_base, targets):
-    if np.any(np.isnan(list(z.values())[0])):
-        return None
-    io.write_z(y, z, targets, '%s_z.h5' % (out_base))
+def eval_io(model, data, out_base, targets, batch_size=128, nb_bin=0,
+            block_size=2**14):
+    """Predicts, writes, and evaluates `data` in one pass over blocks.
+
+    Returns None if predictions are NaN.
+    """
     cla = []
     reg = []
     for k, v in model.loss.items():
@@ -71,30 +67,40 @@ def eval_io(model, y, z, out_base, targets):
             cla.append(k)
         else:
             reg.append(k)
-    p = []
+    evals = []
     if len(cla):
-        ys = {k: y[k] for k in cla}
-        zs = {k: z[k] for k in cla}
-        e = evaluate(ys, zs, targets, funs=ev.eval_funs, mask=io.MASK)
-        if e is not None:
-            print('Classification:')
-            print(e.to_string(index=False))
-            ev.eval_to_file(e, '%s_cla.csv' % (out_base))
-        p.append(e)
-    else:
-        p.append(None)
-
+        evals.append(('Classification', 'cla', ev.StreamEvaluator(
+            cla, mask=io.MASK, funs=ev.eval_funs, nb_bin=nb_bin)))
     if len(reg):
-        ys = {k: y[k] for k in reg}
-        zs = {k: z[k] for k in reg}
-        e = evaluate(ys, zs, targets, funs=ev.eval_funs_regress)
-        if e is not None:
-            print('Regression:')
-            print(e.to_string(index=False))
-            ev.eval_to_file(e, '%s_reg.csv' % (out_base))
+        evals.append(('Regression', 'reg', ev.StreamEvaluator(
+            reg, mask=io.MASK, funs=ev.eval_funs_regress, nb_bin=nb_bin)))
+
+    z_file = '%s_z.h5' % (out_base)
+    writer = io.ZWriter(z_file, targets)
+    nb_sample = len(data['pos'])
+    names = model.input_order + model.output_order + ['pos', 'chromo']
+    for start in range(0, nb_sample, block_size):
+        end = min(start + block_size, nb_sample)
+        block = {k: data[k][start:end] for k in names}
+        z = model.predict(block, batch_size=batch_size)
+        if np.any(np.isnan(list(z.values())[0])):
+            writer.close()
+            os.remove(z_file)
+            return None
+        writer.write(block, z)
+        writer.commit(start)
+        for _, _, evaluator in evals:
+            evaluator.update(block, z)
+    writer.close()
+
+    p = []
+    for title, suffix, evaluator in evals:
+        e = eval_frame(evaluator.evaluate(), targets)
+        print('%s:' % (title))
+        print(e.to_string(index=False))
+        ev.eval_to_file(e, '%s_%s.csv' % (out_base, suffix))
         p.append(e)
-    else:
-        p.append(None)
+    return p
 
 
 def build_model(params, data_file, targets):
@@ -116,12 +122,13 @@ def build_model(params, data_file, targets):
 
 def read_data(path, model, cache_size=None):
     file_, data = io.read_hdf(path, cache_size)
+    # Skip rows without any label
+    index = io.read_coverage(file_, model.output_order)
     weights = dict()
     for k in model.output_order:
-        weights[k] = get_sample_weights(data[k])
-    io.to_view(data)
-    io.to_view(weights)
-    check_weights(model, data, weights)
+        weights[k] = io.WeightView(data[k], get_class_weights(data[k]),
+                                   index=index)
+    io.to_view(data, index=index)
     return (file_, data, weights)
 
 
@@ -195,8 +202,28 @@ class App(object):
             type=int)
         p.add_argument(
             '--batch_size_auto',
-            help='Determine maximum batch size automatically',
+            help='Determine batch size with highest throughput',
             action='store_true')
+        p.add_argument(
+            '--batch_size_steps',
+            help='# timed training steps per batch size',
+            type=int,
+            default=5)
+        p.add_argument(
+            '--batch_size_mem',
+            help='Maximum memory in MB for automatic batch size',
+            type=float)
+        p.add_argument(
+            '--nb_worker',
+            help='# processes for data-parallel training, which requires' +
+            ' --sampler jump',
+            type=int,
+            default=1)
+        p.add_argument(
+            '--sync_every',
+            help='# batches after which weights of workers are averaged',
+            type=int,
+            default=16)
         p.add_argument(
             '--early_stop',
             help='Early stopping patience',
@@ -218,8 +245,19 @@ class App(object):
             default=0.5)
         p.add_argument(
             '--shuffle',
-            help='Data shuffling',
+            help='Data shuffling of jump sampler',
             default='batch')
+        p.add_argument(
+            '--sampler',
+            help='Sample training data from shuffled chunks of the whole ' +
+                 'file (chunk) or from a random window (jump)',
+            choices=['chunk', 'jump'],
+            default='chunk')
+        p.add_argument(
+            '--shuffle_buffer',
+            help='# chunks that are shuffled together by chunk sampler',
+            type=int,
+            default=8)
         p.add_argument(
             '--nb_sample',
             help='Maximum # training samples per epoch',
@@ -228,6 +266,11 @@ class App(object):
             '--nb_val_sample',
             help='Maximum # validation samples per epoch',
             type=int)
+        p.add_argument(
+            '--val_every',
+            help='Validate on stratified subset of --nb_val_sample ' +
+                 'validation samples every this many batches',
+            type=int)
         p.add_argument(
             '--no_jump',
             help='Do not jump in training set',
@@ -241,6 +284,14 @@ class App(object):
             help='Maximum memory load',
             type=int,
             default=14000)
+        p.add_argument(
+            '--resume',
+            help='Resume training from last checkpoint in output directory',
+            action='store_true')
+        p.add_argument(
+            '--timing',
+            help='Log time of data fetching, compute, and callbacks per batch',
+            action='store_true')
         p.add_argument(
             '--compile',
             help='Force model compilation',
@@ -250,7 +301,12 @@ class App(object):
             help='Evaluate performance after training',
             choices=['train', 'val'],
             default='val',
-            nargs='+')
+            nargs='*')
+        p.add_argument(
+            '--eval_bins',
+            help='# histogram bins for approximating AUC (0: exact)',
+            type=int,
+            default=0)
         p.add_argument(
             '--seed',
             help='Seed of rng',
@@ -266,36 +322,78 @@ class App(object):
         return p
 
     def adjust_batch_size(self, model, data, sample_weights):
+        """Chooses batch size with the highest training throughput.
+
+        Times `train_on_batch` after a warm-up step for each batch size and
+        records the resident memory after each trial, and its increase
+        over the memory before the trial. Batch sizes that fail or exceed
+        --batch_size_mem are skipped. Weights and optimizer state are
+        restored afterwards.
+        """
+        opts = self.opts
         configs = [
-            (512, 0.000125),
-            (256, 0.00025),
-            (128, 0.0005),
-            (64, 0.001),
+            (16, 0.001),
             (32, 0.001),
-            (16, 0.001)
+            (64, 0.001),
+            (128, 0.0005),
+            (256, 0.00025),
+            (512, 0.000125)
         ]
-        idx = None
+        weights = model.get_weights()
+        state = model.optimizer.get_state()
         nb_sample = list(data.values())[0].shape[0]
-        for i in range(len(configs)):
-            batch_size = configs[i][0]
+        perf = []
+        for batch_size, lr in configs:
             if batch_size > nb_sample:
-                continue
+                break
             self.log.info('Try batch size %d' % (batch_size))
             batch_data = {k: v[:batch_size] for k, v in data.items()}
             batch_weights = dict()
             for k, v in sample_weights.items():
                 batch_weights[k] = v[:batch_size]
+            rss = ut.rss()
             try:
                 model.train_on_batch(batch_data,
                                      sample_weight=batch_weights)
-                idx = i
-                break
+                t = time()
+                for i in range(opts.batch_size_steps):
+                    model.train_on_batch(batch_data,
+                                         sample_weight=batch_weights)
+                t = time() - t
             except:
+                # Larger batches will not fit either
                 self.log.info('Batch size %d failed!' % (batch_size))
-        if idx is None:
-            return (None, None)
+                break
+            # Current instead of lifetime peak memory, which would include
+            # loading data
+            rss_delta = ut.rss() - rss
+            rss += rss_delta
+            speed = batch_size * opts.batch_size_steps / t
+            perf.append((batch_size, lr, speed, rss, rss_delta))
+            self.log.info('%.1f samples/s, %.0f MB (%+.0f MB)' %
+                          (speed, rss, rss_delta))
+            if opts.batch_size_mem is not None and \
+                    rss > opts.batch_size_mem:
+                break
+        model.set_weights(weights)
+        model.optimizer.set_state(state)
+
+        perf = pd.DataFrame(perf, columns=['batch_size', 'lr',
+                                           'samples_per_s', 'rss',
+                                           'rss_delta'])
+        if opts.batch_size_mem is not None:
+            perf['fits'] = perf.rss <= opts.batch_size_mem
         else:
-            return (configs[idx])
+            perf['fits'] = True
+        with open(pt.join(opts.out_dir, 'batch_size.csv'), 'w') as f:
+            f.write(perf_logs_str(perf))
+        print('\nBatch sizes:')
+        print(perf.to_string(index=False))
+        perf = perf.loc[perf.fits]
+        if len(perf) == 0:
+            return (None, None)
+        best = perf.samples_per_s.values.argmax()
+        return (int(perf.batch_size.values[best]), perf.lr.values[best])
 
     def callbacks(self, model):
         opts = self.opts
@@ -306,13 +404,6 @@ class App(object):
         if opts.max_time is not None:
             cbacks.append(cb.Timer(opts.max_time * 3600 * 0.8))
 
-        h = ModelCheckpoint(pt.join(opts.out_dir, 'model_weights_last.h5'),
-                            save_best_only=False)
-        cbacks.append(h)
-        h = ModelCheckpoint(pt.join(opts.out_dir, 'model_weights.h5'),
-                            save_best_only=True, verbose=1)
-        cbacks.append(h)
-
         def lr_schedule():
             old_lr = model.optimizer.lr.get_value()
             new_lr = old_lr * opts.lr_decay
@@ -325,15 +416,46 @@ class App(object):
         def save_lc():
             log = {'lc.csv': perf_logger.frame(),
                    'lc_batch.csv': perf_logger.batch_frame()}
+            if self.validator is not None:
+                log['lc_val.csv'] = self.validator.frame()
             for k, v in log.items():
                 with open(pt.join(opts.out_dir, k), 'w') as f:
                     f.write(perf_logs_str(v))
 
-        perf_logger = cb.PerformanceLogger(callbacks=[save_lc])
+        perf_logger = cb.PerformanceLogger(
+            batch_logs=['loss', 'acc', 't_fetch', 't_compute', 't_callbacks'],
+            epoch_logs=['val_loss', 'val_acc', 't_checkpoint'],
+            callbacks=[save_lc])
         cbacks.append(perf_logger)
 
         return cbacks
 
+    def fit(self, model, cbacks, train_data, train_weights, val_data,
+            val_weights, batch_size, nb_epoch, nb_train, shuffle):
+        opts = self.opts
+        if opts.nb_worker > 1:
+            # Workers read the file, not the views of samplers
+            loader = par.hdf_loader(opts.train_file, model.output_order,
+                                    opts.max_mem)
+            trainer = par.ParallelTrainer(model, loader,
+                                          nb_worker=opts.nb_worker,
+                                          batch_size=batch_size,
+                                          sync_every=opts.sync_every)
+            trainer.fit(nb_train, nb_sample=opts.nb_sample,
+                        nb_epoch=nb_epoch, callbacks=cbacks,
+                        val_data=val_data, val_sample_weight=val_weights)
+        else:
+            model.fit(data=train_data,
+                      sample_weight=train_weights,
+                      val_data=val_data,
+                      val_sample_weight=val_weights,
+                      batch_size=batch_size,
+                      shuffle=shuffle,
+                      nb_epoch=nb_epoch,
+                      callbacks=cbacks,
+                      verbose=0,
+                      logger=lambda x: self.log.debug(x))
+
     def main(self, name, opts):
         logging.basicConfig(filename=opts.log_file,
                             format='%(levelname)s (%(asctime)s): %(message)s')
@@ -351,11 +473,21 @@ class App(object):
         pd.set_option('display.width', 150)
         self.log = log
         self.opts = opts
+        self.validator = None
+
+        if opts.nb_worker > 1 and opts.sampler == 'chunk':
+            raise ValueError('--nb_worker > 1 requires --sampler jump!')
 
         # Create output directory if not existing
         if not pt.exists(opts.out_dir):
             os.makedirs(opts.out_dir, exist_ok=True)
 
+        state = None
+        state_file = pt.join(opts.out_dir, 'train_state.pkl')
+        if opts.resume and pt.isfile(state_file):
+            with open(state_file, 'rb') as f:
+                state = pickle.load(f)
+
         # Build model
         targets = io.read_targets(opts.train_file, opts.targets)
         if len(targets['name']) == 0:
@@ -414,8 +546,9 @@ class App(object):
 
         log.info('Save model')
         net.model_to_json(model, pt.join(opts.out_dir, 'model.json'))
-        model.save_weights(pt.join(opts.out_dir, 'model_weights.h5'),
-                           overwrite=True)
+        if state is None:
+            model.save_weights(pt.join(opts.out_dir, 'model_weights.h5'),
+                               overwrite=True)
         if model_params is not None:
             h = pt.join(opts.out_dir, 'configs.yaml')
             if not pt.exists(h):
@@ -429,10 +562,27 @@ class App(object):
         log.info('Read training data')
         train_file, train_data, train_weights = read_data(opts.train_file,
                                                           model, opts.max_mem)
-        views = list(train_data.values()) + list(train_weights.values())
-        h = cb.DataJumper(views, nb_sample=opts.nb_sample, verbose=1,
-                           jump=not opts.no_jump)
-        cbacks.append(h)
+        nb_train = list(train_data.values())[0].shape[0]
+        if opts.sampler == 'chunk':
+            # Sample covered rows of views
+            sampler = io.ChunkSampler(
+                {k: v.data for k, v in train_data.items()},
+                nb_sample=opts.nb_sample, nb_buffer=opts.shuffle_buffer,
+                index=list(train_data.values())[0].index)
+            for k in train_data.keys():
+                train_data[k] = io.ArrayView(sampler.view(k))
+            for k, v in train_weights.items():
+                train_weights[k] = io.WeightView(sampler.view(k),
+                                                 v.class_weights)
+            cbacks.append(cb.ChunkShuffler(sampler, verbose=opts.verbose))
+            shuffle = False
+        else:
+            views = list(train_data.values()) + \
+                list(train_weights.values())
+            h = cb.DataJumper(views, nb_sample=opts.nb_sample, verbose=1,
+                              jump=not opts.no_jump)
+            cbacks.append(h)
+            shuffle = opts.shuffle
 
         # Validation data
         log.info('Read validation data')
@@ -443,28 +593,88 @@ class App(object):
         else:
             val_file, val_data, val_weights = read_data(opts.val_file, model,
                                                         opts.max_mem)
-            views = list(val_data.values()) + list(val_weights.values())
+            if not opts.val_every:
+                views = list(val_data.values()) + list(val_weights.values())
+                nb_sample = opts.nb_val_sample
+                if nb_sample is None:
+                    nb_sample = opts.nb_sample
+                h = cb.DataJumper(views, nb_sample=nb_sample, verbose=1,
+                                  jump=False)
+                cbacks.append(h)
+        if opts.val_every:
+            log.info('Load validation subset')
             nb_sample = opts.nb_val_sample
             if nb_sample is None:
-                nb_sample = opts.nb_sample
-            h = cb.DataJumper(views, nb_sample=nb_sample, verbose=1,
-                               jump=False)
-            cbacks.append(h)
+                nb_sample = len(val_data['chromo'])
+            idx = io.stratified_index(val_data['chromo'], nb_sample)
+            val_data = {k: v[idx] for k, v in val_data.items()}
+            val_weights = {k: v[idx] for k, v in val_weights.items()}
 
         # Define batch size
-        if opts.batch_size:
+        if state is not None:
+            batch_size = state['batch_size']
+        elif opts.batch_size:
             batch_size = opts.batch_size
         elif opts.batch_size_auto or model_params is None:
             log.info('Adjust batch size')
             batch_size, lr = self.adjust_batch_size(model, train_data,
                                                     train_weights)
             if batch_size is None:
-                log.error('GPU memory to small')
+                log.error('No batch size fits into memory!')
                 return 1
             model.optimizer.lr.set_value(lr)
         else:
             batch_size = model_params.batch_size
 
+        best_file = pt.join(opts.out_dir, 'model_weights.h5')
+        fit_val_data = val_data
+        if opts.val_every:
+            # Validate every val_every batches instead of every epoch
+            monitors = [x for x in cbacks if isinstance(
+                x, (cb.EarlyStopping, cb.LearningRateScheduler))]
+            cbacks = [x for x in cbacks if x not in monitors]
+            h = cb.AsyncCheckpoint(None, best_file, verbose=1)
+            self.validator = cb.Validator(val_data, val_weights,
+                                          every=opts.val_every,
+                                          batch_size=batch_size,
+                                          callbacks=monitors + [h],
+                                          verbose=opts.verbose)
+            cbacks.insert(0, self.validator)
+            best_file = None
+            fit_val_data = None
+
+        # Checkpoint weights and training state after other callbacks
+        perf_logger = [x for x in cbacks
+                       if isinstance(x, cb.PerformanceLogger)][0]
+        checkpoint = cb.AsyncCheckpoint(
+            pt.join(opts.out_dir, 'model_weights_last.h5'), best_file,
+            state_file, callbacks=list(cbacks), perf_logger=perf_logger,
+            verbose=1)
+        checkpoint.state['batch_size'] = batch_size
+        cbacks.append(checkpoint)
+        if opts.timing:
+            views = []
+            for v in list(train_data.values()) + list(train_weights.values()):
+                v.data = io.TimedView(v.data)
+                views.append(v.data)
+            timer = cb.StepTimer(views)
+            cbacks.insert(0, timer.head)
+            cbacks.append(timer.tail)
+
+        nb_epoch = opts.nb_epoch
+        if state is not None:
+            log.info('Resume training after epoch %d' % (state['epoch']))
+            model.load_weights(checkpoint.last_file)
+            checkpoint.restore(state)
+            nb_epoch = max(0, nb_epoch - state['epoch'])
+            if state['stop_training']:
+                nb_epoch = 0
+
+        nb_skip = train_file['pos/pos'].shape[0] - nb_train
+        if nb_skip:
+            log.info('Skip %d unlabeled training samples (%d batches)' %
+                     (nb_skip, np.ceil(nb_skip / batch_size)))
+
         # Print infos
         print('\nInput arguments:')
         print(ut.dict_to_str(opts.__dict__))
@@ -484,16 +694,15 @@ class App(object):
 
         # Train model
         log.info('Train model')
-        model.fit(data=train_data,
-                  sample_weight=train_weights,
-                  val_data=val_data,
-                  val_sample_weight=val_weights,
-                  batch_size=batch_size,
-                  shuffle=opts.shuffle,
-                  nb_epoch=opts.nb_epoch,
-                  callbacks=cbacks,
-                  verbose=0,
-                  logger=lambda x: log.debug(x))
+        try:
+            self.fit(model, cbacks, train_data, train_weights, fit_val_data,
+                     val_weights, batch_size, nb_epoch, nb_train, shuffle)
+        except cb.StopTraining:
+            log.info('Stop training')
+            # Checkpoint interrupted epoch with stopped state
+            checkpoint.on_epoch_end(nb_epoch, dict())
+            for cback in cbacks:
+                cback.on_train_end()
 
         # Use best weights on validation set
         h = pt.join(opts.out_dir, 'model_weights.h5')
@@ -508,31 +717,27 @@ class App(object):
             net.model_to_pickle(model, h)
 
         if opts.nb_epoch > 0:
-            for cback in cbacks:
-                if isinstance(cback, cb.PerformanceLogger):
-                    perf_logger = cback
-                    break
             lc = perf_logger.frame()
             print('\n\nLearning curve:')
             print(perf_logs_str(lc))
             if len(lc) > 5:
                 lc = lc.loc[lc.epoch > 2]
-            lc.set_index('epoch', inplace=True)
-            ax = lc.plot(figsize=(10, 6))
-            ax.get_figure().savefig(pt.join(opts.out_dir, 'lc.png'))
+            if len(lc):
+                lc.set_index('epoch', inplace=True)
+                ax = lc.plot(figsize=(10, 6))
+                ax.get_figure().savefig(pt.join(opts.out_dir, 'lc.png'))
 
         if opts.eval is not None and 'train' in opts.eval:
             log.info('Evaluate training set performance')
-            z = model.predict(train_data, batch_size=batch_size)
             print('\nTraining set performance:')
-            eval_io(model, train_data, z, pt.join(opts.out_dir, 'train'),
-                    targets)
+            eval_io(model, train_data, pt.join(opts.out_dir, 'train'),
+                    targets, batch_size, opts.eval_bins)
 
         if opts.eval is not None and 'val' in opts.eval:
             log.info('Evaluate validation set performance')
-            z = model.predict(val_data, batch_size=batch_size)
             print('\nValidation set performance:')
-            eval_io(model, val_data, z, pt.join(opts.out_dir, 'val'), targets)
+            eval_io(model, val_data, pt.join(opts.out_dir, 'val'), targets,
+                    batch_size, opts.eval_bins)
 
         train_file.close()
         if val_file: